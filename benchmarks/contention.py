@@ -0,0 +1,94 @@
+"""
+Many allocators hammering one SKU at once, with and without retries on
+concurrent updates. Defaults to a SQLite file; pass a database URI to run
+against Postgres.
+
+    PYTHONPATH=src python benchmarks/contention.py [allocators] [database-uri]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from fakes import NullNotifications
+
+ORDERS_PER_ALLOCATOR = 20
+
+
+def run(uri, allocators, retries):
+    engine = create_engine(uri)
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    metrics = InMemoryMetrics()
+    buses = []
+    for _ in range(allocators):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            notifications=NullNotifications(),
+            metrics=metrics,
+        )
+        bus.retries = retries
+        buses.append(bus)
+    buses[0].handle(commands.CreateBatch("batch", "CONTENDED-SKU", 1_000_000))
+
+    failures = []
+
+    def allocate(i, bus):
+        for n in range(ORDERS_PER_ALLOCATOR):
+            try:
+                bus.handle(commands.Allocate(f"order-{i}-{n}", "CONTENDED-SKU", 1))
+            except unit_of_work.ConcurrentUpdate as e:
+                failures.append(e)
+
+    threads = [
+        threading.Thread(target=allocate, args=(i, bus))
+        for i, bus in enumerate(buses)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+
+    attempted = allocators * ORDERS_PER_ALLOCATOR
+    allocated = attempted - len(failures)
+    retried = sum(
+        value
+        for (name, _), value in metrics.counters.items()
+        if name == "messagebus_retries_total"
+    )
+    print(
+        f"retries={retries:<3} {allocated:>5}/{attempted} allocated,"
+        f" {retried:>5.0f} retried, {allocated / elapsed:>7.0f} allocations/s"
+    )
+
+
+def main():
+    allocators = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    if len(sys.argv) > 2:
+        uri = sys.argv[2]
+    else:
+        uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "contention.db")
+    print(f"{allocators} allocators, {ORDERS_PER_ALLOCATOR} orders each")
+    orm.start_mappers()
+    try:
+        for retries in (0, 3, 10):
+            run(uri, allocators, retries)
+    finally:
+        clear_mappers()
+
+
+if __name__ == "__main__":
+    main()
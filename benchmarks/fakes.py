@@ -0,0 +1,41 @@
+from allocation.adapters import notifications, repository
+from allocation.service_layer import unit_of_work
+
+
+class InMemoryRepository(repository.AbstractRepository):
+    def __init__(self):
+        super().__init__()
+        self._products = {}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        return next(
+            (
+                p
+                for p in self._products.values()
+                for b in p.batches
+                if b.reference == batchref
+            ),
+            None,
+        )
+
+
+class InMemoryUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self):
+        self.products = InMemoryRepository()
+
+    def _commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class NullNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
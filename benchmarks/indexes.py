@@ -0,0 +1,128 @@
+"""
+Lookups by orderid, sku, batch reference and order line against large
+tables, before and after the index migration. Seeds a database with the
+schema as it was before migrations existed; defaults to a SQLite file, pass
+a database URI to run against Postgres (its tables are dropped first).
+
+    PYTHONPATH=src python benchmarks/indexes.py [lines] [database-uri]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy import create_engine, text
+from allocation.adapters import migrations, orm
+
+LINES_PER_BATCH = 50
+LOOKUPS = 200
+
+QUERIES = {
+    "view by orderid": "SELECT sku, batchref FROM allocations_view"
+    " WHERE orderid = :orderid",
+    "lines by orderid and sku": "SELECT id FROM order_lines"
+    " WHERE orderid = :orderid AND sku = :sku",
+    "batches by sku": "SELECT id FROM batches WHERE sku = :sku",
+    "batch by reference": "SELECT id FROM batches WHERE reference = :ref",
+    "allocation by order line": "SELECT batch_id FROM allocations"
+    " WHERE orderline_id = :line_id",
+    "lines of a batch": "SELECT orderline_id FROM allocations"
+    " WHERE batch_id = :batch_id",
+}
+
+
+def seed(engine, lines):
+    orm.metadata.drop_all(engine)
+    migrations.schema_migrations.drop(engine, checkfirst=True)
+    migrations.create_tables(engine)
+    batch_count = lines // LINES_PER_BATCH
+    skus = [f"SKU-{i}" for i in range(batch_count // 10 or 1)]
+    with engine.begin() as conn:
+        conn.execute(orm.products.insert(), [{"sku": sku} for sku in skus])
+        conn.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    id=i + 1,
+                    reference=f"batch-{i}",
+                    sku=skus[i % len(skus)],
+                    _purchased_quantity=LINES_PER_BATCH,
+                )
+                for i in range(batch_count)
+            ],
+        )
+        conn.execute(
+            orm.order_lines.insert(),
+            [
+                dict(id=i + 1, orderid=f"order-{i}", sku=skus[i % len(skus)], qty=1)
+                for i in range(lines)
+            ],
+        )
+        conn.execute(
+            orm.allocations.insert(),
+            [
+                {"orderline_id": i + 1, "batch_id": i // LINES_PER_BATCH + 1}
+                for i in range(lines)
+            ],
+        )
+        conn.execute(
+            orm.allocations_view.insert(),
+            [
+                {
+                    "orderid": f"order-{i}",
+                    "sku": skus[i % len(skus)],
+                    "batchref": f"batch-{i // LINES_PER_BATCH}",
+                }
+                for i in range(lines)
+            ],
+        )
+    return batch_count, skus
+
+
+def time_lookups(engine, lines, batch_count, skus):
+    results = {}
+    with engine.connect() as conn:
+        for name, query in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(LOOKUPS):
+                i = random.randrange(lines)
+                conn.execute(
+                    text(query),
+                    dict(
+                        orderid=f"order-{i}",
+                        sku=skus[i % len(skus)],
+                        ref=f"batch-{i % batch_count}",
+                        line_id=i + 1,
+                        batch_id=i % batch_count + 1,
+                    ),
+                ).all()
+            results[name] = (time.perf_counter() - start) / LOOKUPS
+    return results
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    if len(sys.argv) > 2:
+        uri = sys.argv[2]
+    else:
+        uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "indexes.db")
+    engine = create_engine(uri)
+    print(f"seeding {lines} order lines...")
+    batch_count, skus = seed(engine, lines)
+
+    before = time_lookups(engine, lines, batch_count, skus)
+    start = time.perf_counter()
+    migrations.add_indexes(engine)
+    print(f"indexes built in {time.perf_counter() - start:.1f}s\n")
+    after = time_lookups(engine, lines, batch_count, skus)
+
+    print(f"{'lookup':<26} {'before':>10} {'after':>10}")
+    for name in QUERIES:
+        print(
+            f"{name:<26} {before[name] * 1000:>8.2f}ms {after[name] * 1000:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Bytes per allocated order line, and per command/event, before and after the
+compact representations.
+
+    PYTHONPATH=src python benchmarks/memory_per_line.py [number-of-lines]
+"""
+import dataclasses
+import gc
+import sys
+import tracemalloc
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import orm, repository
+from allocation.domain import commands, events, model
+
+
+def bytes_per_item(make, n):
+    gc.collect()
+    tracemalloc.start()
+    items = make(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size / n
+
+
+def unslotted(cls):
+    return dataclasses.make_dataclass(
+        cls.__name__, [(f.name, f.type) for f in dataclasses.fields(cls)]
+    )
+
+
+def message_sizes(n):
+    samples = [
+        (commands.Allocate, ("order-00001", "SMALL-TABLE", 10)),
+        (events.Allocated, ("order-00001", "SMALL-TABLE", 10, "batch-001")),
+        (events.Deallocated, ("order-00001", "SMALL-TABLE", 10)),
+    ]
+    for cls, args in samples:
+        before = bytes_per_item(
+            lambda n, c=unslotted(cls): [c(*args) for _ in range(n)], n
+        )
+        after = bytes_per_item(lambda n, c=cls: [c(*args) for _ in range(n)], n)
+        yield cls.__name__, before, after
+
+
+def seeded_session_factory(n):
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(orm.products.insert(), dict(sku="SMALL-TABLE", version_number=1))
+        conn.execute(
+            orm.batches.insert(),
+            dict(
+                id=1,
+                reference="batch-001",
+                sku="SMALL-TABLE",
+                _purchased_quantity=n,
+                _allocated_quantity=n,
+            ),
+        )
+        conn.execute(
+            orm.order_lines.insert(),
+            [
+                dict(id=i, orderid=f"order-{i:08}", sku="SMALL-TABLE", qty=1)
+                for i in range(1, n + 1)
+            ],
+        )
+        conn.execute(
+            orm.allocations.insert(),
+            [dict(orderline_id=i, batch_id=1) for i in range(1, n + 1)],
+        )
+    return sessionmaker(bind=engine)
+
+
+def bytes_per_loaded_line(session_factory, n):
+    def load(_):
+        session = session_factory()
+        product = repository.SqlAlchemyRepository(session).get("SMALL-TABLE")
+        [batch] = product.batches
+        assert batch.allocated_quantity == n
+        assert len(batch._allocations) == n  # lines are loaded on first use
+        return session, product
+
+    return bytes_per_item(load, n)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"{'bytes per item':<24}{'before':>10}{'after':>10}")
+    for name, before, after in message_sizes(n):
+        print(f"{name:<24}{before:>10.0f}{after:>10.0f}")
+
+    orm.start_mappers()
+    session_factory = seeded_session_factory(n)
+    event.remove(model.OrderLine, "load", orm.intern_sku)
+    before = bytes_per_loaded_line(session_factory, n)
+    event.listen(model.OrderLine, "load", orm.intern_sku)
+    after = bytes_per_loaded_line(session_factory, n)
+    clear_mappers()
+    print(f"{'loaded OrderLine':<24}{before:>10.0f}{after:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Time a cascade of events through the message bus: shrinking a batch with
+many single-unit lines deallocates all of them, and each one is reallocated
+to a second batch, so one command fans out into Deallocated and Allocated
+events for every line.
+
+    PYTHONPATH=src python benchmarks/messagebus_cascade.py [number-of-lines]
+"""
+import sys
+import time
+from collections import deque
+from allocation import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus
+from fakes import InMemoryUnitOfWork, NullNotifications
+
+
+class ListQueueMessageBus(messagebus.MessageBus):
+    """The bus as it was, popping from the front of a list."""
+
+    def handle_many(self, messages):
+        self.queue = list(messages)
+        while self.queue:
+            message = self.queue.pop(0)
+            if isinstance(message, events.Event):
+                self.handle_event(message)
+            else:
+                self.handle_command(message)
+
+
+class ListQueueUnitOfWork(InMemoryUnitOfWork):
+    def collect_new_events(self):
+        for product in self.products.seen:
+            while product.events:
+                yield product.events.pop(0)
+
+
+def run_cascade(bus_class, uow, lines):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=NullNotifications(),
+    )
+    bus = bus_class(bus.uow, bus.event_handlers, bus.command_handlers)
+    bus.handle_many(
+        [
+            commands.CreateBatch("in-stock", "BIG-CASCADE", lines),
+            commands.CreateBatch("overflow", "BIG-CASCADE", lines),
+            commands.AllocateMany("BIG-CASCADE", [(f"o{i}", 1) for i in range(lines)]),
+        ]
+    )
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("in-stock", 0))
+    return time.perf_counter() - start
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    handlers.EVENT_HANDLERS[events.Allocated] = []  # no read model to update
+    handlers.EVENT_HANDLERS[events.Deallocated] = [handlers.reallocate]
+    print(f"cascade of {lines} Deallocated + {lines} Allocated events")
+    before = run_cascade(ListQueueMessageBus, ListQueueUnitOfWork(), lines)
+    print(f"list queue:  {before:.3f}s")
+    after = run_cascade(messagebus.MessageBus, InMemoryUnitOfWork(), lines)
+    print(f"deque queue: {after:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
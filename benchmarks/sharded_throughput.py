@@ -0,0 +1,67 @@
+"""
+Allocation throughput of the sharded bus as shards are added. Each commit
+waits for a simulated database round trip, which releases the GIL the way a
+real driver does while it waits on the network.
+
+    PYTHONPATH=src python benchmarks/sharded_throughput.py [round-trip-ms]
+"""
+
+import os
+import sys
+import time
+from allocation import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer import handlers
+from fakes import InMemoryUnitOfWork, NullNotifications
+
+SKUS = 64
+ALLOCATIONS_PER_SKU = 50
+
+
+def uow_with_latency(seconds):
+    class SlowUnitOfWork(InMemoryUnitOfWork):
+        def _commit(self):
+            time.sleep(seconds)
+
+    return SlowUnitOfWork
+
+
+def allocations_per_second(shards, round_trip):
+    bus = bootstrap.bootstrap_sharded(
+        shards=shards,
+        start_orm=False,
+        uow_factory=uow_with_latency(round_trip),
+        notifications_factory=NullNotifications,
+    )
+    skus = [f"sku-{i}" for i in range(SKUS)]
+    bus.handle_many(
+        [commands.CreateBatch(f"batch-{sku}", sku, 10_000) for sku in skus]
+    )
+    allocations = [
+        commands.Allocate(f"order-{i}", sku, 1)
+        for i in range(ALLOCATIONS_PER_SKU)
+        for sku in skus
+    ]
+    start = time.perf_counter()
+    bus.handle_many(allocations)
+    elapsed = time.perf_counter() - start
+    bus.close()
+    return len(allocations) / elapsed
+
+
+def main():
+    handlers.EVENT_HANDLERS[events.Allocated] = []  # no read model to update
+    round_trip = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.002
+    print(f"{os.cpu_count()} cpus, {round_trip * 1000:.1f}ms per commit")
+    baseline = None
+    for shards in (1, 2, 4, 8, 16):
+        throughput = allocations_per_second(shards, round_trip)
+        baseline = baseline or throughput
+        print(
+            f"{shards:>3} shards: {throughput:>8.0f} allocations/s"
+            f"  ({throughput / baseline:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Cold-start time of each entry point: a fresh interpreter importing the
+module, which for the Flask app includes bootstrapping the bus. No database,
+Redis or SMTP server needs to be running; an entry point that tries to
+reach one at import time shows up as failing.
+
+    PYTHONPATH=src python benchmarks/startup.py [runs]
+"""
+
+import subprocess
+import sys
+
+ENTRY_POINTS = [
+    "allocation.service_layer.unit_of_work",
+    "allocation.bootstrap",
+    "allocation.entrypoints.flask_app",
+    "allocation.entrypoints.redis_eventconsumer",
+    "allocation.entrypoints.outbox_relay",
+]
+
+TIMED_IMPORT = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def startup_seconds(module):
+    result = subprocess.run(
+        [sys.executable, "-c", TIMED_IMPORT.format(module=module)],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return None
+    return float(result.stdout)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in ENTRY_POINTS:
+        timings = [startup_seconds(module) for _ in range(runs)]
+        if None in timings:
+            print(f"{module:<45} fails without its backing services")
+        else:
+            print(f"{module:<45} {min(timings) * 1000:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
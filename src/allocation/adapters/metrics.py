@@ -0,0 +1,114 @@
+# pylint: disable=too-few-public-methods
+import abc
+import bisect
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+Labels = Optional[Dict[str, str]]
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+class AbstractMetrics(abc.ABC):
+    enabled = True
+
+    @abc.abstractmethod
+    def increment(self, name: str, labels: Labels = None, amount: float = 1):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, labels: Labels = None):
+        raise NotImplementedError
+
+
+class NullMetrics(AbstractMetrics):
+    enabled = False
+
+    def increment(self, name, labels=None, amount=1):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class InMemoryMetrics(AbstractMetrics):
+    """
+    Keeps counters and histograms in process and renders them in the
+    Prometheus text format. Histograms whose names end in _seconds get
+    latency buckets, everything else gets size buckets.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)  # type: Dict[tuple, float]
+        self.histograms = {}  # type: Dict[tuple, Histogram]
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels=None, amount=1):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] += amount
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self.histograms:
+                buckets = (
+                    LATENCY_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS
+                )
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def render(self) -> str:
+        lines = []  # type: List[str]
+        with self._lock:
+            for name, series in _by_name(self.counters):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series:
+                    lines.append(f"{name}{_format(labels)} {value:g}")
+            for name, series in _by_name(self.histograms):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in series:
+                    cumulative = 0
+                    bounds = [f"{b:g}" for b in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        bucket_labels = labels + (("le", bound),)
+                        lines.append(
+                            f"{name}_bucket{_format(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_key(labels: Labels) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _by_name(series: dict):
+    grouped = defaultdict(list)
+    for (name, labels), value in sorted(series.items(), key=lambda kv: kv[0]):
+        grouped[name].append((labels, value))
+    return grouped.items()
+
+
+def _format(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
@@ -0,0 +1,278 @@
+"""
+Versioned schema migrations. Each one runs once per database, in order, and
+is recorded in schema_migrations. They're written to be safe to run again
+and to leave the application running while they do: indexes are built
+CONCURRENTLY on Postgres, and backfills commit a chunk of rows at a time.
+
+Each migration spells out what it changes rather than reading orm.py, so it
+does the same thing whenever it runs. A new database is built by applying
+them all; a change to the tables in orm.py needs a new migration.
+"""
+import logging
+from typing import Callable, List, NamedTuple, Tuple
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    func,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_CHUNK_SIZE = 10000
+ADVISORY_LOCK_ID = 4_200_023  # any number that no other advisory lock uses
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Engine], None]
+
+
+class IndexSpec(NamedTuple):
+    name: str
+    table: str
+    columns: Tuple[str, ...]
+    unique: bool = False
+
+
+MIGRATIONS = []  # type: List[Migration]
+
+
+def migration(version: int, name: str):
+    def register(apply):
+        MIGRATIONS.append(Migration(version, name, apply))
+        return apply
+
+    return register
+
+
+# the tables as they were before migrations existed
+initial_tables = MetaData()
+Table(
+    "order_lines",
+    initial_tables,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("orderid", String(255)),
+)
+Table(
+    "products",
+    initial_tables,
+    Column("sku", String(255), primary_key=True),
+    Column("version_number", Integer, nullable=False, server_default="0"),
+)
+Table(
+    "batches",
+    initial_tables,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("reference", String(255)),
+    Column("sku", ForeignKey("products.sku")),
+    Column("_purchased_quantity", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+)
+Table(
+    "allocations",
+    initial_tables,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderline_id", ForeignKey("order_lines.id")),
+    Column("batch_id", ForeignKey("batches.id")),
+)
+Table(
+    "allocations_view",
+    initial_tables,
+    Column("orderid", String(255)),
+    Column("sku", String(255)),
+    Column("batchref", String(255)),
+)
+Table(
+    "outbox",
+    initial_tables,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+)
+
+# what migration 3 builds; later indexes belong in later migrations
+LOOKUP_INDEXES = [
+    IndexSpec(
+        "ix_allocations_batch_id_orderline_id",
+        "allocations",
+        ("batch_id", "orderline_id"),
+        unique=True,
+    ),
+    IndexSpec("ix_allocations_orderline_id", "allocations", ("orderline_id",)),
+    IndexSpec(
+        "ix_allocations_view_orderid_sku", "allocations_view", ("orderid", "sku")
+    ),
+    IndexSpec("ix_batches_reference", "batches", ("reference",), unique=True),
+    IndexSpec("ix_batches_sku", "batches", ("sku",)),
+    IndexSpec("ix_order_lines_orderid_sku", "order_lines", ("orderid", "sku")),
+]
+
+
+@migration(1, "create tables")
+def create_tables(engine: Engine):
+    initial_tables.create_all(engine)
+
+
+@migration(2, "store each batch's allocated quantity")
+def add_allocated_quantity(engine: Engine):
+    if "_allocated_quantity" in _columns(engine, "batches"):
+        return
+    with engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            conn.execute(
+                text(
+                    "ALTER TABLE batches"
+                    " ADD COLUMN _allocated_quantity INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+        else:
+            # adding the column with a default would rewrite the table
+            conn.execute(
+                text("ALTER TABLE batches ADD COLUMN _allocated_quantity INTEGER")
+            )
+            conn.execute(
+                text(
+                    "ALTER TABLE batches"
+                    " ALTER COLUMN _allocated_quantity SET DEFAULT 0"
+                )
+            )
+    backfill_allocated_quantity(engine)
+    if engine.dialect.name != "sqlite":
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "ALTER TABLE batches"
+                    " ALTER COLUMN _allocated_quantity SET NOT NULL"
+                )
+            )
+
+
+@migration(3, "index lookups by orderid, sku, batch and order line")
+def add_indexes(engine: Engine):
+    for index in LOOKUP_INDEXES:
+        create_index(engine, index)
+
+
+def backfill_allocated_quantity(
+    engine: Engine, chunk_size: int = BACKFILL_CHUNK_SIZE
+):
+    with engine.connect() as conn:
+        last_id = conn.execute(text("SELECT MAX(id) FROM batches")).scalar() or 0
+    for start in range(0, last_id, chunk_size):
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    """
+                    UPDATE batches SET _allocated_quantity = (
+                        SELECT COALESCE(SUM(ol.qty), 0)
+                        FROM allocations a
+                        JOIN order_lines ol ON ol.id = a.orderline_id
+                        WHERE a.batch_id = batches.id
+                    )
+                    WHERE id > :start AND id <= :end
+                    """
+                ),
+                dict(start=start, end=start + chunk_size),
+            )
+        logger.info("backfilled batches up to id %d", start + chunk_size)
+
+
+def create_index(engine: Engine, index: IndexSpec):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        postgres = conn.dialect.name == "postgresql"
+        if postgres and _is_invalid(conn, index.name):
+            # left behind by a concurrent build that failed part way
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {index.name}"))
+        if index.name in _indexes(conn, index.table):
+            return
+        logger.info("creating index %s", index.name)
+        unique = "UNIQUE " if index.unique else ""
+        concurrently = " CONCURRENTLY" if postgres else ""
+        columns = ", ".join(index.columns)
+        conn.execute(
+            text(
+                f"CREATE {unique}INDEX{concurrently} {index.name}"
+                f" ON {index.table} ({columns})"
+            )
+        )
+
+
+def applied_versions(engine: Engine) -> List[int]:
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return list(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def migrate(engine: Engine, target: int = None) -> List[Migration]:
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        if lock.dialect.name == "postgresql":
+            # one process migrates, the others wait for it
+            lock.execute(
+                text("SELECT pg_advisory_lock(:id)"), dict(id=ADVISORY_LOCK_ID)
+            )
+        try:
+            return _apply_pending(engine, target)
+        finally:
+            if lock.dialect.name == "postgresql":
+                lock.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), dict(id=ADVISORY_LOCK_ID)
+                )
+
+
+def _apply_pending(engine: Engine, target: int = None) -> List[Migration]:
+    applied = set(applied_versions(engine))
+    pending = [
+        m
+        for m in sorted(MIGRATIONS)
+        if m.version not in applied and (target is None or m.version <= target)
+    ]
+    for m in pending:
+        logger.info("applying migration %d: %s", m.version, m.name)
+        m.apply(engine)
+        with engine.begin() as conn:
+            conn.execute(
+                schema_migrations.insert().values(version=m.version, name=m.name)
+            )
+    return pending
+
+
+def _columns(engine: Engine, table: str) -> List[str]:
+    return [column["name"] for column in inspect(engine).get_columns(table)]
+
+
+def _indexes(conn: Connection, table: str) -> List[str]:
+    return [index["name"] for index in inspect(conn).get_indexes(table)]
+
+
+def _is_invalid(conn: Connection, name: str) -> bool:
+    return bool(
+        conn.execute(
+            text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid"
+                " WHERE relname = :name AND NOT indisvalid"
+            ),
+            dict(name=name),
+        ).first()
+    )
@@ -10,14 +10,19 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
-
-
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=None, port=None):
+        email_config = config.get_email_host_and_port()
+        self.smtp_host = smtp_host or email_config["host"]
+        self.port = port or email_config["port"]
+        self._server = None  # connected on the first send
+
+    @property
+    def server(self) -> smtplib.SMTP:
+        if self._server is None:
+            self._server = smtplib.SMTP(self.smtp_host, port=self.port)
+            self._server.noop()
+        return self._server
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
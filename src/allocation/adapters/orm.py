@@ -1,4 +1,5 @@
 import logging
+import sys
 from sqlalchemy import (
     Table,
     MetaData,
@@ -7,9 +8,13 @@ from sqlalchemy import (
     String,
     Date,
     ForeignKey,
+    Index,
+    Text,
     event,
+    exists,
+    select,
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm import mapper, object_session, relationship
 
 from allocation.domain import model
 
@@ -24,6 +29,7 @@ order_lines = Table(
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    Index("ix_order_lines_orderid_sku", "orderid", "sku"),
 )
 
 products = Table(
@@ -37,9 +43,10 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("reference", String(255), unique=True, index=True),
+    Column("sku", ForeignKey("products.sku"), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
+    Column("_allocated_quantity", Integer, nullable=False, server_default="0"),
     Column("eta", Date, nullable=True),
 )
 
@@ -47,8 +54,15 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
     Column("batch_id", ForeignKey("batches.id")),
+    # also serves loading a batch's lines
+    Index(
+        "ix_allocations_batch_id_orderline_id",
+        "batch_id",
+        "orderline_id",
+        unique=True,
+    ),
 )
 
 allocations_view = Table(
@@ -57,12 +71,32 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
 )
 
 
 def start_mappers():
     logger.info("Starting mappers")
-    lines_mapper = mapper(model.OrderLine, order_lines)
+    lines_mapper = mapper(
+        model.OrderLine,
+        order_lines,
+        properties={
+            "_batch": relationship(
+                model.Batch,
+                secondary=allocations,
+                uselist=False,
+                back_populates="_allocations",
+            )
+        },
+    )
     batches_mapper = mapper(
         model.Batch,
         batches,
@@ -71,6 +105,7 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                back_populates="_batch",
             )
         },
     )
@@ -78,9 +113,63 @@ def start_mappers():
         model.Product,
         products,
         properties={"batches": relationship(batches_mapper)},
+        # the domain bumps version_number itself, and every UPDATE of a
+        # product checks that nobody else has bumped it first
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
+class PersistedLines(model.LineStore):
+    """
+    A loaded batch's lines, looked up and added in the database until the
+    batch's collection is loaded anyway.
+    """
+
+    def contains(self, batch, line):
+        session = object_session(batch)
+        if "_allocations" in batch.__dict__ or session is None:
+            return line in batch._allocations
+        allocated = (
+            exists()
+            .where(allocations.c.orderline_id == order_lines.c.id)
+            .where(allocations.c.batch_id == batches.c.id)
+            .where(batches.c.reference == batch.reference)
+            .where(order_lines.c.orderid == line.orderid)
+            .where(order_lines.c.sku == line.sku)
+            .where(order_lines.c.qty == line.qty)
+        )
+        return session.execute(select(allocated)).scalar()
+
+    def add(self, batch, line):
+        if "_allocations" in batch.__dict__ or object_session(batch) is None:
+            batch._allocations.add(line)
+            return
+        # the backref queues the line for the batch's collection without
+        # loading it
+        setattr(line, "_batch", batch)
+
+
+persisted_lines = PersistedLines()
+
+
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._index = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    batch.line_store = persisted_lines
+
+
+@event.listens_for(model.OrderLine, "load")
+@event.listens_for(model.Batch, "load")
+def intern_sku(obj, _):
+    # mapped classes can't use __slots__, but sharing one copy of the sku
+    # across every loaded row still saves a string per order line. Writing
+    # to __dict__ directly keeps the attribute unmodified as far as the ORM
+    # is concerned.
+    if obj.sku is not None:
+        obj.__dict__["sku"] = sys.intern(obj.sku)
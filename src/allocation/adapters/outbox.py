@@ -0,0 +1,60 @@
+"""
+Integration events are written to the outbox table in the same transaction
+as the aggregate that raised them, and a relay publishes them to Redis
+afterwards. Delivery is at least once: a relay that dies after publishing
+but before deleting its batch will publish that batch again.
+"""
+import json
+import logging
+from dataclasses import asdict
+from typing import Any, Dict, Iterable, List, Set, Type, cast
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from allocation.adapters import orm
+from allocation.domain import events, model
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = {
+    events.Allocated: "line_allocated",
+}  # type: Dict[Type[events.Event], str]
+
+
+def pending_messages(
+    products: Iterable[model.Product], written: Set[int]
+) -> List[Dict[str, str]]:
+    messages = []
+    for product in products:
+        for event in product.events:
+            channel = CHANNELS.get(type(event))
+            if channel is None or id(event) in written:
+                continue
+            written.add(id(event))
+            # every concrete event is a dataclass, though Event itself isn't
+            payload = json.dumps(asdict(cast(Any, event)))
+            messages.append({"channel": channel, "payload": payload})
+    return messages
+
+
+def relay(session: Session, redis_client, batch_size: int = 500) -> int:
+    rows = session.execute(
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+        .order_by(orm.outbox.c.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not rows:
+        return 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    for row in rows:
+        pipe.publish(row.channel, row.payload)
+    pipe.execute()
+    logger.debug("relayed %d messages", len(rows))
+
+    session.execute(
+        orm.outbox.delete().where(orm.outbox.c.id.in_([r.id for r in rows]))
+    )
+    session.commit()
+    return len(rows)
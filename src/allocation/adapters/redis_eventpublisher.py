@@ -1,16 +1,12 @@
-import json
-import logging
-from dataclasses import asdict
-import redis
+# pylint: disable=import-outside-toplevel
+import functools
 
 from allocation import config
-from allocation.domain import events
 
-logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+@functools.lru_cache(maxsize=None)
+def client():
+    # imported and built on first use, so bootstrapping doesn't pay for redis
+    import redis
 
-
-def publish(channel, event: events.Event):
-    logging.info("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    return redis.Redis(**config.get_redis_host_and_port())
@@ -1,8 +1,18 @@
 import abc
-from typing import Set
-from allocation.adapters import orm
+import csv
+import io
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+from allocation.adapters import metrics as metrics_, orm
 from allocation.domain import model
 
+BatchRow = Tuple[str, str, int, Optional[date]]  # (ref, sku, qty, eta)
+
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
@@ -24,6 +34,29 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def add_batches(self, batches: Iterable[BatchRow]):
+        """
+        Adds many batches at once, creating any products that don't exist
+        yet. This goes through the domain model one product at a time;
+        repositories backed by a database can do better.
+        """
+        by_sku = defaultdict(list)  # type: Dict[str, List[model.Batch]]
+        for ref, sku, qty, eta in batches:
+            by_sku[sku].append(model.Batch(ref, sku, qty, eta))
+        for sku, new_batches in by_sku.items():
+            product = self.get(sku)
+            if product is None:
+                product = model.Product(sku, batches=[])
+                self.add(product)
+            for batch in new_batches:
+                product.add_batch(batch)
+
+    def remember_batchrefs(self, product: model.Product):
+        """
+        Notes which product the batches belong to, for repositories that keep
+        track of it. Nothing to do otherwise.
+        """
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -37,23 +70,287 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
 
+class ProductCache:
+    """
+    Products kept in memory between units of work, evicting the least
+    recently used. A unit of work checks a product out while it uses it and
+    only checks it back in when it commits, so a product whose changes were
+    rolled back is simply dropped.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.load_seconds = 0.0  # moving average of a full reload
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._products)
+
+    def checkout(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            return self._products.pop(sku, None)
+
+    def checkin(self, products: Iterable[model.Product]):
+        with self._lock:
+            for product in products:
+                self._products[product.sku] = product
+                self._products.move_to_end(product.sku)
+            while len(self._products) > self.maxsize:
+                self._products.popitem(last=False)
+
+    def record_load(self, seconds: float):
+        if self.load_seconds:
+            seconds = 0.9 * self.load_seconds + 0.1 * seconds
+        self.load_seconds = seconds
+
+
+class BatchrefIndex:
+    """
+    The sku of each recently seen batch reference, evicting the least
+    recently used. A reference that has been evicted is looked up again.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self._skus = OrderedDict()  # type: OrderedDict[str, str]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._skus)
+
+    def get(self, batchref: str) -> Optional[str]:
+        with self._lock:
+            sku = self._skus.get(batchref)
+            if sku is not None:
+                self._skus.move_to_end(batchref)
+            return sku
+
+    def __setitem__(self, batchref: str, sku: str):
+        with self._lock:
+            self._skus[batchref] = sku
+            self._skus.move_to_end(batchref)
+            while len(self._skus) > self.maxsize:
+                self._skus.popitem(last=False)
+
+
+def loader_options(strategy: str) -> list:
+    """
+    How a Product's batches are loaded. Batches carry their allocated
+    quantity, so a batch's order lines are only loaded, on first use, when
+    they have to be looked at:
+    lazy -- one query for the batches, the first time they're needed
+    selectin -- two queries, whatever the number of batches
+    joined -- one query, repeating product columns on every row
+    """
+    if strategy == "lazy":
+        return []
+    if strategy == "selectin":
+        return [selectinload(model.Product.batches)]
+    if strategy == "joined":
+        return [joinedload(model.Product.batches)]
+    raise ValueError(f"Unknown loading strategy {strategy}")
+
+
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        cache: ProductCache = None,
+        metrics: metrics_.AbstractMetrics = None,
+        loading: str = "selectin",
+        skus_by_batchref: BatchrefIndex = None,
+    ):
         super().__init__()
         self.session = session
+        self.cache = cache
+        self.metrics = metrics or metrics_.NullMetrics()
+        self.options = loader_options(loading)
+        self.skus_by_batchref = (
+            BatchrefIndex() if skus_by_batchref is None else skus_by_batchref
+        )
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        if self.cache is None:
+            return self._query().filter_by(sku=sku).first()
+
+        start = time.perf_counter()
+        cached = self.cache.checkout(sku)
+        if cached is not None and cached.version_number == self._version_of(sku):
+            self.session.add(cached)
+            saved = self.cache.load_seconds - (time.perf_counter() - start)
+            self.metrics.increment("product_cache_hits_total")
+            self.metrics.increment(
+                "product_cache_saved_seconds_total", amount=max(saved, 0)
+            )
+            return cached
+
+        reason = "absent" if cached is None else "stale"
+        self.metrics.increment("product_cache_misses_total", {"reason": reason})
+        start = time.perf_counter()
+        product = self._query().filter_by(sku=sku).first()
+        self.cache.record_load(time.perf_counter() - start)
+        return product
+
+    def _version_of(self, sku) -> Optional[int]:
+        return self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
 
     def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
+        sku = self.skus_by_batchref.get(batchref)
+        if sku is not None:
+            product = self._get(sku)
+            if product and any(b.reference == batchref for b in product.batches):
+                self.metrics.increment("batchref_lookups_total", {"source": "map"})
+                return product
+
+        self.metrics.increment("batchref_lookups_total", {"source": "query"})
+        product = (
+            self._query()
             .join(model.Batch)
             .filter(
                 orm.batches.c.reference == batchref,
             )
             .first()
         )
+        if product is not None:
+            self.remember_batchrefs(product)
+        return product
+
+    def add_batches(self, batches):
+        # straight to the tables: loading each product to append a batch
+        # would cost more than the insert itself
+        rows = sorted(batches, key=lambda row: row[1])
+        if not rows:
+            return
+        skus = {sku for _, sku, _, _ in rows}
+        existing = set(
+            self.session.execute(
+                select(orm.products.c.sku).where(orm.products.c.sku.in_(skus))
+            ).scalars()
+        )
+        if skus - existing:
+            self.session.execute(
+                orm.products.insert(),
+                [
+                    {"sku": sku, "version_number": 1}
+                    for sku in sorted(skus - existing)
+                ],
+            )
+        if existing:
+            # so that cached copies of these products are known to be stale
+            self.session.execute(
+                orm.products.update()
+                .where(orm.products.c.sku.in_(existing))
+                .values(version_number=orm.products.c.version_number + 1)
+            )
+        if self.session.get_bind().dialect.name == "postgresql":
+            self._copy_batches(rows)
+        else:
+            self.session.execute(
+                orm.batches.insert(),
+                [
+                    {
+                        "reference": ref,
+                        "sku": sku,
+                        "_purchased_quantity": qty,
+                        "eta": eta,
+                    }
+                    for ref, sku, qty, eta in rows
+                ],
+            )
+        for ref, sku, _, _ in rows:
+            self.skus_by_batchref[ref] = sku
+
+    def _copy_batches(self, rows: List[BatchRow]):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for ref, sku, qty, eta in rows:
+            writer.writerow([ref, sku, qty, eta.isoformat() if eta else ""])
+        buffer.seek(0)
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                "COPY batches (reference, sku, _purchased_quantity, eta)"
+                " FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+        finally:
+            cursor.close()
+
+    def remember_batchrefs(self, product: model.Product):
+        for batch in product.batches:
+            self.skus_by_batchref[batch.reference] = product.sku
+
+    def _query(self):
+        return self.session.query(model.Product).options(*self.options)
+
+
+class AbstractAsyncRepository(abc.ABC):
+    def __init__(self):
+        self.seen = set()  # type: Set[model.Product]
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> model.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, batchref) -> model.Product:
+        product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    @abc.abstractmethod
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get(self, sku) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_by_batchref(self, batchref) -> model.Product:
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyRepository(AbstractAsyncRepository):
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        return await self._first(select(model.Product).filter_by(sku=sku))
+
+    async def _get_by_batchref(self, batchref):
+        return await self._first(
+            select(model.Product)
+            .join(model.Batch)
+            .filter(
+                orm.batches.c.reference == batchref,
+            )
+        )
+
+    async def _first(self, query):
+        # lazy loads can't happen under asyncio, so the whole aggregate,
+        # order lines included, is loaded up front
+        result = await self.session.execute(
+            query.options(
+                selectinload(model.Product.batches).selectinload(
+                    model.Batch._allocations
+                )
+            )
+        )
+        return result.scalars().first()
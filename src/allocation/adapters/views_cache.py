@@ -0,0 +1,144 @@
+# pylint: disable=import-outside-toplevel
+"""
+Read-through caches for views, keyed by orderid. Entries are dropped when
+Allocated and Deallocated events reach the read model, and expire after a
+TTL regardless: the in-process tier only hears about events raised in its
+own process, and a read that races an invalidation can put back what it
+read.
+"""
+import abc
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class Entry:
+    rows: List[dict]
+    etag: str
+
+    @classmethod
+    def of(cls, rows: List[dict]) -> "Entry":
+        body = json.dumps(rows, sort_keys=True).encode()
+        return cls(rows, hashlib.sha1(body).hexdigest())
+
+
+class AbstractViewsCache(abc.ABC):
+    @abc.abstractmethod
+    def get(self, orderid: str) -> Optional[Entry]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, orderid: str, entry: Entry):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def invalidate(self, *orderids: str):
+        raise NotImplementedError
+
+
+class InMemoryViewsCache(AbstractViewsCache):
+    """
+    Entries kept in process, evicting the least recently used, until they're
+    ttl seconds old.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, Entry]]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, orderid):
+        with self._lock:
+            expires_at, entry = self._entries.get(orderid, (0.0, None))
+            if entry is None:
+                return None
+            if expires_at <= time.monotonic():
+                del self._entries[orderid]
+                return None
+            self._entries.move_to_end(orderid)
+            return entry
+
+    def set(self, orderid, entry):
+        with self._lock:
+            self._entries[orderid] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(orderid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *orderids):
+        with self._lock:
+            for orderid in orderids:
+                self._entries.pop(orderid, None)
+
+
+class RedisViewsCache(AbstractViewsCache):
+    """
+    Entries shared by every process, so an invalidation reaches them all.
+    """
+
+    def __init__(self, client=None, ttl: float = 30.0, prefix: str = "allocations:"):
+        self._client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @property
+    def client(self):
+        if self._client is None:
+            from allocation.adapters import redis_eventpublisher
+
+            self._client = redis_eventpublisher.client()
+        return self._client
+
+    def get(self, orderid):
+        cached = self.client.get(self.prefix + orderid)
+        if cached is None:
+            return None
+        return Entry(**json.loads(cached))
+
+    def set(self, orderid, entry):
+        payload = json.dumps({"rows": entry.rows, "etag": entry.etag})
+        self.client.set(self.prefix + orderid, payload, px=int(self.ttl * 1000))
+
+    def invalidate(self, *orderids):
+        if orderids:
+            self.client.delete(*(self.prefix + orderid for orderid in orderids))
+
+
+class TieredViewsCache(AbstractViewsCache):
+    def __init__(self, local: AbstractViewsCache, shared: AbstractViewsCache):
+        self.local = local
+        self.shared = shared
+
+    def get(self, orderid):
+        entry = self.local.get(orderid)
+        if entry is None:
+            entry = self.shared.get(orderid)
+            if entry is not None:
+                self.local.set(orderid, entry)
+        return entry
+
+    def set(self, orderid, entry):
+        self.shared.set(orderid, entry)
+        self.local.set(orderid, entry)
+
+    def invalidate(self, *orderids):
+        self.shared.invalidate(*orderids)
+        self.local.invalidate(*orderids)
+
+
+def build(
+    size: int = 10000, ttl: float = 5.0, redis: bool = False, redis_ttl: float = 30.0
+) -> AbstractViewsCache:
+    local = InMemoryViewsCache(maxsize=size, ttl=ttl)
+    if not redis:
+        return local
+    return TieredViewsCache(local, RedisViewsCache(ttl=redis_ttl))
@@ -1,30 +1,73 @@
+import asyncio
+import functools
 import inspect
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
 from typing import Callable
-from allocation.adapters import orm, redis_eventpublisher
+from allocation import config
+from allocation.adapters import orm
+from allocation.adapters.metrics import AbstractMetrics, NullMetrics
 from allocation.adapters.notifications import (
     AbstractNotifications,
     EmailNotifications,
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.adapters.views_cache import AbstractViewsCache, InMemoryViewsCache
+from allocation.service_layer import (
+    async_handlers,
+    handlers,
+    messagebus,
+    unit_of_work,
+)
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
+    metrics: AbstractMetrics = None,
+    background: Executor = None,
+    background_uow: unit_of_work.AbstractUnitOfWork = None,
+    views_cache: AbstractViewsCache = None,
 ) -> messagebus.MessageBus:
 
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
     if notifications is None:
         notifications = EmailNotifications()
 
+    if views_cache is None:
+        views_cache = InMemoryViewsCache()
+
+    if metrics is None:
+        metrics = NullMetrics()
+    uow.metrics = metrics
+    # connection pools are per process, so the last bus bootstrapped reports
+    # on them
+    unit_of_work.report_pool_metrics(metrics)
+
+    if background_uow is None:
+        # only safe while background handlers run on the caller's thread
+        background_uow = uow
+    background_uow.metrics = metrics
+
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "views_cache": views_cache,
+    }
+    dependencies_by_lane = {
+        messagebus.FOREGROUND: dependencies,
+        messagebus.BACKGROUND: dict(dependencies, uow=background_uow),
+    }
     injected_event_handlers = {
         event_type: [
-            inject_dependencies(handler, dependencies)
+            inject_dependencies(
+                handler, dependencies_by_lane[messagebus.lane_of(handler)]
+            )
             for handler in event_handlers
         ]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
@@ -38,9 +81,92 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        metrics=metrics,
+        background=background,
+        **config.get_retry_settings(),
+    )
+
+
+def bootstrap_async(
+    start_orm: bool = True,
+    uow: unit_of_work.AbstractAsyncUnitOfWork = None,
+    notifications: AbstractNotifications = None,
+    executor: Executor = None,
+    metrics: AbstractMetrics = None,
+    views_cache: AbstractViewsCache = None,
+) -> messagebus.AsyncMessageBus:
+
+    if uow is None:
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork()
+
+    if notifications is None:
+        notifications = EmailNotifications()
+
+    if views_cache is None:
+        views_cache = InMemoryViewsCache()
+
+    if metrics is None:
+        metrics = NullMetrics()
+    uow.metrics = metrics
+
+    if executor is None:
+        # one thread, so sync handlers never share a connection concurrently
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="handlers")
+
+    if start_orm:
+        orm.start_mappers()
+
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "views_cache": views_cache,
+    }
+    injected_event_handlers = {
+        event_type: [
+            inject_async_dependencies(handler, dependencies, executor)
+            for handler in event_handlers
+        ]
+        for event_type, event_handlers in async_handlers.EVENT_HANDLERS.items()
+    }
+    injected_command_handlers = {
+        command_type: inject_async_dependencies(handler, dependencies, executor)
+        for command_type, handler in async_handlers.COMMAND_HANDLERS.items()
+    }
+
+    return messagebus.AsyncMessageBus(
+        uow=uow,
+        event_handlers=injected_event_handlers,
+        command_handlers=injected_command_handlers,
+        metrics=metrics,
+        **config.get_retry_settings(),
     )
 
 
+def bootstrap_sharded(
+    shards: int = os.cpu_count() or 1,
+    start_orm: bool = True,
+    uow_factory: Callable[
+        [], unit_of_work.AbstractUnitOfWork
+    ] = unit_of_work.SqlAlchemyUnitOfWork,
+    notifications_factory: Callable[[], AbstractNotifications] = EmailNotifications,
+    metrics: AbstractMetrics = None,
+) -> messagebus.ShardedMessageBus:
+
+    if start_orm:
+        orm.start_mappers()
+
+    buses = [
+        bootstrap(
+            start_orm=False,
+            uow=uow_factory(),
+            notifications=notifications_factory(),
+            metrics=metrics,
+        )
+        for _ in range(shards)
+    ]
+    return messagebus.ShardedMessageBus(buses=buses, uow=uow_factory())
+
+
 def inject_dependencies(handler, dependencies):
     params = inspect.signature(handler).parameters
     deps = {
@@ -48,4 +174,17 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    return functools.wraps(handler)(lambda message: handler(message, **deps))
+
+
+def inject_async_dependencies(handler, dependencies, executor):
+    injected = inject_dependencies(handler, dependencies)
+    if inspect.iscoroutinefunction(handler):
+        return injected
+
+    @functools.wraps(handler)
+    async def run_in_executor(message):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, functools.partial(injected, message))
+
+    return run_in_executor
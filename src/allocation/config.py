@@ -1,12 +1,65 @@
 import os
 
 
-def get_postgres_uri():
+def get_postgres_uri(driver="postgresql", role="write"):
     host = os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
+    if role == "replica":
+        host = os.environ.get("DB_REPLICA_HOST", host)
+        port = int(os.environ.get("DB_REPLICA_PORT", 5432))
     password = os.environ.get("DB_PASSWORD", "abc123")
     user, db_name = "allocation", "allocation"
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    return f"{driver}://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_async_postgres_uri():
+    return get_postgres_uri(driver="postgresql+asyncpg")
+
+
+def get_pool_settings(role="write"):
+    # DB_READ_POOL_SIZE etc. override DB_POOL_SIZE for one role's engine
+    def setting(name, default):
+        return os.environ.get(
+            f"DB_{role.upper()}_{name}", os.environ.get(f"DB_{name}", default)
+        )
+
+    return dict(
+        pool_size=int(setting("POOL_SIZE", 5)),
+        max_overflow=int(setting("MAX_OVERFLOW", 10)),
+        pool_timeout=float(setting("POOL_TIMEOUT", 30)),
+        pool_recycle=int(setting("POOL_RECYCLE", 1800)),
+        pool_pre_ping=setting("POOL_PRE_PING", "true").lower() in ("1", "true"),
+    )
+
+
+def get_replica_settings():
+    # without DB_REPLICA_HOST, reads go to the primary
+    return dict(
+        enabled="DB_REPLICA_HOST" in os.environ,
+        max_lag=float(os.environ.get("DB_REPLICA_MAX_LAG", 5)),
+        lag_check_interval=float(os.environ.get("DB_REPLICA_LAG_CHECK_INTERVAL", 1)),
+        connect_timeout=int(os.environ.get("DB_REPLICA_CONNECT_TIMEOUT", 2)),
+    )
+
+
+def get_product_loading_strategy():
+    return os.environ.get("PRODUCT_LOADING_STRATEGY", "selectin")
+
+
+def get_retry_settings():
+    retries = int(os.environ.get("MESSAGEBUS_RETRIES", 3))
+    backoff = float(os.environ.get("MESSAGEBUS_RETRY_BACKOFF", 0.01))
+    return dict(retries=retries, backoff=backoff)
+
+
+def get_views_cache_settings():
+    # VIEWS_CACHE_REDIS adds a shared tier in front of the in-process one
+    return dict(
+        size=int(os.environ.get("VIEWS_CACHE_SIZE", 10000)),
+        ttl=float(os.environ.get("VIEWS_CACHE_TTL", 5)),
+        redis=os.environ.get("VIEWS_CACHE_REDIS", "false").lower() in ("1", "true"),
+        redis_ttl=float(os.environ.get("VIEWS_CACHE_REDIS_TTL", 30)),
+    )
 
 
 def get_api_url():
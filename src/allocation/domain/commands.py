@@ -1,13 +1,15 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
+from .slots import slotted
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
+@slotted
 @dataclass
 class Allocate(Command):
     orderid: str
@@ -15,6 +17,14 @@ class Allocate(Command):
     qty: int
 
 
+@slotted
+@dataclass
+class AllocateMany(Command):
+    sku: str
+    lines: List[Tuple[str, int]]  # (orderid, qty) pairs
+
+
+@slotted
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -23,6 +33,13 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
+@slotted
+@dataclass
+class ImportBatches(Command):
+    batches: List[Tuple[str, str, int, Optional[date]]]  # (ref, sku, qty, eta)
+
+
+@slotted
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
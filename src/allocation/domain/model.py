@@ -1,21 +1,46 @@
 from __future__ import annotations
+import abc
+import bisect
+import heapq
+import math
+import sys
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Iterable, Optional, List, Set, Tuple
 from . import commands, events
 
 
 class Product:
+    batches: List[Batch]
+
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._index = None  # type: Optional[BatchIndex]
 
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._index is not None and len(self._index) == len(self.batches) - 1:
+            self._index.insert(batch)
+        self.version_number += 1
+
+    def allocate(self, line: OrderLine) -> Optional[str]:
+        [batchref] = self.allocate_many([line])
+        return batchref
+
+    def allocate_many(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        index = self._batch_index()
+        batchrefs = []  # type: List[Optional[str]]
+        for line in lines:
+            batch = index.first_fit(line)
+            if batch is None:
+                self.events.append(events.OutOfStock(line.sku))
+                batchrefs.append(None)
+                continue
             batch.allocate(line)
+            index.update(batch)
             self.version_number += 1
             self.events.append(
                 events.Allocated(
@@ -25,17 +50,131 @@ class Product:
                     batchref=batch.reference,
                 )
             )
-            return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
-            return None
+            batchrefs.append(batch.reference)
+        return batchrefs
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+        for line in batch.deallocate_excess():
             self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        self._batch_index().update(batch)
+        self.version_number += 1
+
+    def _batch_index(self) -> BatchIndex:
+        # batches can also be appended to directly (or loaded by the ORM),
+        # so rebuild whenever the index no longer covers all of them
+        if self._index is None or len(self._index) != len(self.batches):
+            self._index = BatchIndex(self.batches)
+        return self._index
+
+
+class BatchIndex:
+    """
+    Batches in allocation preference order (warehouse stock first, then by
+    ETA), with a max-tree over their available quantities so that the first
+    batch able to take a given quantity is found in O(log n).
+    """
+
+    def __init__(self, batches: Iterable[Batch]):
+        self._batches = sorted(batches)
+        self._keys = [_preference(b) for b in self._batches]
+        self._build()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def insert(self, batch: Batch):
+        # bisect_right keeps ties in insertion order, just like a stable sort
+        position = bisect.bisect_right(self._keys, _preference(batch))
+        self._batches.insert(position, batch)
+        self._keys.insert(position, _preference(batch))
+        self._build()
+
+    def update(self, batch: Batch):
+        node = self._size + self._positions[batch.reference]
+        self._set(node, batch.available_quantity)
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        """
+        The first batch that can take the line. A batch whose quantity
+        changed without an update() is corrected when the search reaches it,
+        and the search goes on past any batch that can't take the line.
+        """
+        qty = line.qty
+        skipped = []  # type: List[int]
+        try:
+            while self._batches and self._tree[1] >= qty:
+                node = 1
+                while node < self._size:
+                    node = 2 * node if self._tree[2 * node] >= qty else 2 * node + 1
+                batch = self._batches[node - self._size]
+                if batch.can_allocate(line):
+                    return batch
+                if self._tree[node] != batch.available_quantity:
+                    self._set(node, batch.available_quantity)
+                else:
+                    skipped.append(node)
+                    self._set(node, -math.inf)
+            return None
+        finally:
+            for node in skipped:
+                self._set(node, self._batches[node - self._size].available_quantity)
+
+    def _set(self, node: int, quantity: float):
+        self._tree[node] = quantity
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def _build(self):
+        self._positions = {b.reference: i for i, b in enumerate(self._batches)}
+        self._size = 1
+        while self._size < len(self._batches):
+            self._size *= 2
+        self._tree = [-math.inf] * (2 * self._size)  # type: List[float]
+        for i, batch in enumerate(self._batches):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in reversed(range(1, self._size)):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+
+def _preference(batch: Batch) -> Tuple[bool, date]:
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+def plan_deallocation(lines: Iterable[OrderLine], excess: int) -> List[OrderLine]:
+    """
+    Pick the order lines to give up so that at least `excess` stock is freed,
+    using as few lines as possible and, among those, freeing little more
+    than needed. Every line given up has to be reallocated, so fewer lines
+    means fewer events downstream.
+    """
+    if excess <= 0:
+        return []
+    largest_first = [(-line.qty, i, line) for i, line in enumerate(lines)]
+    heapq.heapify(largest_first)
+    chosen = []  # type: List[OrderLine]
+    freed = 0
+    while largest_first and freed < excess:
+        *_, line = heapq.heappop(largest_first)
+        chosen.append(line)
+        freed += line.qty
+    if chosen:
+        # taking the largest lines gives the fewest of them, but the last one
+        # can be swapped for the smallest leftover line that still covers
+        # what the others don't
+        still_needed = excess - (freed - chosen[-1].qty)
+        chosen[-1] = min(
+            (line for *_, line in largest_first if line.qty >= still_needed),
+            key=lambda line: line.qty,
+            default=chosen[-1],
+        )
+    return chosen
 
 
 @dataclass(unsafe_hash=True)
@@ -44,14 +183,37 @@ class OrderLine:
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # a product can have a great many lines, all for the same sku
+        self.sku = sys.intern(self.sku)
+
+
+class LineStore(abc.ABC):
+    """
+    Where a batch's allocated lines are kept when they aren't all in memory,
+    such as in a database, so that allocating doesn't need every one of them.
+    """
+
+    @abc.abstractmethod
+    def contains(self, batch: Batch, line: OrderLine) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, batch: Batch, line: OrderLine):
+        raise NotImplementedError
+
 
 class Batch:
+    _allocations: Set[OrderLine]
+    line_store = None  # type: Optional[LineStore]
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
-        self.sku = sku
+        self.sku = sys.intern(sku)
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # kept in step with _allocations
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -72,15 +234,45 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and not self.is_allocated(line):
+            self._add_allocation(line)
+            self._allocated_quantity = self.allocated_quantity + line.qty
+
+    def is_allocated(self, line: OrderLine) -> bool:
+        if self.line_store is not None:
+            return self.line_store.contains(self, line)
+        return line in self._allocations
+
+    def _add_allocation(self, line: OrderLine):
+        if self.line_store is not None:
+            self.line_store.add(self, line)
+        else:
             self._allocations.add(line)
 
+    def deallocate(self, line: OrderLine):
+        allocated = self.allocated_quantity
+        self._allocations.remove(line)
+        self._allocated_quantity = allocated - line.qty
+
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
+
+    def deallocate_excess(self) -> List[OrderLine]:
+        if self.available_quantity >= 0:
+            return []
+        lines = plan_deallocation(self._allocations, -self.available_quantity)
+        for line in lines:
+            self.deallocate(line)
+        return lines
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # stored alongside the batch, so that working out what's available
+        # doesn't need every allocated line
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -0,0 +1,84 @@
+"""
+What-if allocation for capacity planning.
+
+Runs the same greedy policy as Product.allocate (first batch of the
+product's sku, in preference order, with enough stock left) over large
+arrays of hypothetical order lines, without touching the product or its
+batches.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import List, Sequence
+import numpy as np
+from . import model
+
+
+@dataclass
+class Simulation:
+    batchrefs: List[str]  # in preference order
+    purchased: np.ndarray  # per batch
+    allocated: np.ndarray  # per batch, existing allocations plus simulated ones
+    assignments: np.ndarray  # batch position per line, -1 where out of stock
+
+    @property
+    def available(self) -> np.ndarray:
+        return self.purchased - self.allocated
+
+    @property
+    def out_of_stock(self) -> np.ndarray:
+        return np.flatnonzero(self.assignments < 0)
+
+
+def simulate(product: model.Product, quantities: Sequence[int]) -> Simulation:
+    qtys = np.asarray(quantities, dtype=np.int64)
+    if (qtys < 0).any():
+        raise ValueError("line quantities cannot be negative")
+
+    batches = sorted(product.batches)
+    allocated = np.array([b.allocated_quantity for b in batches], dtype=np.int64)
+    available = np.array([b.available_quantity for b in batches], dtype=np.int64)
+    purchased = allocated + available
+    # batches of another sku never take the product's lines
+    other_sku = np.array([b.sku != product.sku for b in batches], dtype=bool)
+    rooms = np.where(other_sku, -1, available)
+    assignments = np.full(len(qtys), -1, dtype=np.int64)
+
+    # a line goes to a later batch only if every earlier one turned it down,
+    # and a batch's choices depend only on the lines it has already taken,
+    # so each batch can take its pick of the leftovers in one go
+    pending = np.arange(len(qtys))
+    for position, room in enumerate(rooms):
+        if not len(pending):
+            break
+        taken = _taken_by_batch(qtys[pending], room)
+        assignments[pending[taken]] = position
+        allocated[position] += qtys[pending[taken]].sum()
+        pending = pending[~taken]
+
+    return Simulation(
+        batchrefs=[b.reference for b in batches],
+        purchased=purchased,
+        allocated=allocated,
+        assignments=assignments,
+    )
+
+
+def _taken_by_batch(qtys: np.ndarray, room: int) -> np.ndarray:
+    """
+    Which lines, in arrival order, a batch with `room` left would take if it
+    took each one that still fitted.
+    """
+    taken = np.zeros(len(qtys), dtype=bool)
+    candidates = np.flatnonzero(qtys <= room)
+    while len(candidates):
+        running = np.cumsum(qtys[candidates])
+        fitting = int(np.searchsorted(running, room, side="right"))
+        taken[candidates[:fitting]] = True
+        if fitting == len(candidates):
+            break
+        # the first line that didn't fit never will, as room only shrinks
+        if fitting:
+            room -= running[fitting - 1]
+        rest = candidates[fitting + 1 :]
+        candidates = rest[qtys[rest] <= room]
+    return taken
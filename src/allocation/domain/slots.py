@@ -0,0 +1,17 @@
+from dataclasses import fields
+
+
+def slotted(cls):
+    """
+    Rebuild a dataclass with __slots__ for its fields instead of a per-instance
+    __dict__, like dataclass(slots=True) on Python 3.10+, but also for fields
+    that have defaults. Its base classes need empty __slots__ too.
+    """
+    names = tuple(f.name for f in fields(cls))
+    namespace = {
+        key: value
+        for key, value in cls.__dict__.items()
+        if key not in names + ("__dict__", "__weakref__")
+    }
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
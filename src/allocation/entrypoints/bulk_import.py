@@ -0,0 +1,80 @@
+"""
+Imports batches from a CSV file (with a ref,sku,qty,eta header) or from
+NDJSON, one object per line with the same keys, a chunk per transaction.
+
+    python -m allocation.entrypoints.bulk_import batches.csv [--chunk-size N]
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import sys
+import time
+from datetime import date
+from typing import IO, Iterable, Iterator, List
+
+from allocation import bootstrap
+from allocation.adapters.repository import BatchRow
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+
+def read_batches(stream: IO[str], fmt: str) -> Iterator[BatchRow]:
+    if fmt == "csv":
+        rows = csv.DictReader(stream)  # type: Iterable[dict]
+    else:
+        rows = (json.loads(line) for line in stream if line.strip())
+    for row in rows:
+        eta = row.get("eta") or None
+        yield (
+            row["ref"],
+            row["sku"],
+            int(row["qty"]),
+            date.fromisoformat(eta) if eta else None,
+        )
+
+
+def chunked(batches: Iterable[BatchRow], size: int) -> Iterator[List[BatchRow]]:
+    batches = iter(batches)
+    while True:
+        chunk = list(itertools.islice(batches, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_batches(bus, batches: Iterable[BatchRow], chunk_size: int = 5000) -> int:
+    imported = 0
+    for chunk in chunked(batches, chunk_size):
+        bus.handle(commands.ImportBatches(chunk))
+        imported += len(chunk)
+        logger.info("imported %d batches", imported)
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import batches")
+    parser.add_argument("path", help="CSV or NDJSON file, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+
+    bus = bootstrap.bootstrap()
+    start = time.perf_counter()
+    if args.path == "-":
+        imported = import_batches(bus, read_batches(sys.stdin, fmt), args.chunk_size)
+    else:
+        with open(args.path, newline="") as stream:
+            imported = import_batches(bus, read_batches(stream, fmt), args.chunk_size)
+    elapsed = time.perf_counter() - start
+    print(
+        f"imported {imported} batches in {elapsed:.1f}s"
+        f" ({imported / elapsed:.0f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,30 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
+from allocation.adapters import views_cache as views_cache_
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.adapters.repository import ProductCache
 from allocation.domain import commands
 from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation.service_layer import unit_of_work
+from allocation import bootstrap, config, views
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+metrics = InMemoryMetrics()
+views_cache = views_cache_.build(**config.get_views_cache_settings())
+bus = bootstrap.bootstrap(
+    uow=unit_of_work.SqlAlchemyUnitOfWork(cache=ProductCache()),
+    metrics=metrics,
+    background=ThreadPoolExecutor(max_workers=1, thread_name_prefix="background"),
+    background_uow=unit_of_work.SqlAlchemyUnitOfWork(role="read"),
+    views_cache=views_cache,
+)
+read_uow = unit_of_work.ReadOnlyUnitOfWork()
+read_uow.metrics = metrics
+# a stale read from the replica would be cached for the whole TTL
+cache_fill_uow = unit_of_work.ReadOnlyUnitOfWork(use_replica=False)
+cache_fill_uow.metrics = metrics
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -35,7 +54,29 @@ def allocate_endpoint():
 
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
-    if not result:
+    entry = views.cached_allocations(orderid, cache_fill_uow, views_cache)
+    if not entry.rows:
         return "not found", 404
-    return jsonify(result), 200
+    response = jsonify(entry.rows)
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+
+@app.route("/allocations/query", methods=["POST"])
+def allocations_query_endpoint():
+    body = request.json
+    orderids = body.get("orderids") if isinstance(body, dict) else None
+    if not isinstance(orderids, list) or not all(
+        isinstance(orderid, str) for orderid in orderids
+    ):
+        return {"message": "orderids must be a list of strings"}, 400
+    rows = views.allocations_for(orderids, read_uow)
+    return Response(
+        stream_with_context(json.dumps(row) + "\n" for row in rows),
+        mimetype="application/x-ndjson",
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
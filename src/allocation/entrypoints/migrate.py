@@ -0,0 +1,33 @@
+"""
+Brings the database schema up to date, or to a given migration.
+
+    python -m allocation.entrypoints.migrate [--target N] [--list]
+"""
+import argparse
+import logging
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import migrations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate the database schema")
+    parser.add_argument("--target", type=int, help="stop after this migration")
+    parser.add_argument("--list", action="store_true", help="show what's applied")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine(config.get_postgres_uri())
+    if args.list:
+        applied = set(migrations.applied_versions(engine))
+        for m in migrations.MIGRATIONS:
+            status = "applied" if m.version in applied else "pending"
+            print(f"{m.version:>4} {status:<8} {m.name}")
+        return
+    for m in migrations.migrate(engine, args.target):
+        print(f"applied {m.version}: {m.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import logging
+import os
+import time
+import redis
+
+from allocation import config
+from allocation.adapters import outbox
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 500))
+POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", 0.1))
+
+
+def main():
+    logger.info("Outbox relay starting")
+    r = redis.Redis(**config.get_redis_host_and_port())
+    session_factory = unit_of_work.default_session_factory()
+    while True:
+        with session_factory() as session:
+            relayed = outbox.relay(session, r, BATCH_SIZE)
+        if relayed < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
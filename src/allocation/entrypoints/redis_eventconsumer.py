@@ -7,11 +7,10 @@ from allocation.domain import commands
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
-
 
 def main():
     logger.info("Redis pubsub starting")
+    r = redis.Redis(**config.get_redis_host_and_port())
     bus = bootstrap.bootstrap()
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
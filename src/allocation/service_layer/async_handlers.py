@@ -0,0 +1,121 @@
+# pylint: disable=unused-argument
+"""
+Coroutine versions of the handlers that go through a unit of work, for the
+AsyncMessageBus. Handlers with no unit of work are shared with the sync bus
+and run in an executor.
+"""
+from __future__ import annotations
+from dataclasses import asdict
+from typing import List, Dict, Callable, Type, Union, TYPE_CHECKING
+from allocation.domain import commands, events, model
+from allocation.domain.model import OrderLine
+from .messagebus import batched
+from .handlers import (
+    InvalidSku,
+    allocations_view_changes,
+    invalidate_cached_allocations,
+    send_out_of_stock_notification,
+)
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+
+async def add_batch(
+    cmd: commands.CreateBatch,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get(sku=cmd.sku)
+        if product is None:
+            product = model.Product(cmd.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        await uow.commit()
+
+
+async def allocate(
+    cmd: commands.Allocate,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        product.allocate(line)
+        await uow.commit()
+
+
+async def allocate_many(
+    cmd: commands.AllocateMany,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    lines = [OrderLine(orderid, cmd.sku, qty) for orderid, qty in cmd.lines]
+    async with uow:
+        product = await uow.products.get(sku=cmd.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {cmd.sku}")
+        product.allocate_many(lines)
+        await uow.commit()
+
+
+async def reallocate(
+    event: events.Deallocated,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    await allocate(commands.Allocate(**asdict(event)), uow=uow)
+
+
+async def change_batch_quantity(
+    cmd: commands.ChangeBatchQuantity,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        await uow.commit()
+
+
+@batched
+async def update_allocations_view(
+    allocation_events: List[Union[events.Allocated, events.Deallocated]],
+    uow: unit_of_work.AsyncSqlAlchemyUnitOfWork,
+):
+    deletes, inserts = allocations_view_changes(allocation_events)
+    async with uow:
+        if deletes:
+            await uow.session.execute(
+                """
+                DELETE FROM allocations_view
+                WHERE orderid = :orderid AND sku = :sku
+                """,
+                deletes,
+            )
+        if inserts:
+            await uow.session.execute(
+                """
+                INSERT INTO allocations_view (orderid, sku, batchref)
+                VALUES (:orderid, :sku, :batchref)
+                """,
+                inserts,
+            )
+        await uow.commit()
+
+
+EVENT_HANDLERS = {
+    events.Allocated: [update_allocations_view, invalidate_cached_allocations],
+    events.Deallocated: [
+        update_allocations_view,
+        invalidate_cached_allocations,
+        reallocate,
+    ],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+}  # type: Dict[Type[commands.Command], Callable]
@@ -1,12 +1,13 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
 from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from typing import List, Dict, Callable, Tuple, Type, Union, TYPE_CHECKING
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from .messagebus import background, batched
 
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
+    from allocation.adapters import notifications, views_cache
     from . import unit_of_work
 
 
@@ -23,7 +24,16 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        uow.commit()
+
+
+def import_batches(
+    cmd: commands.ImportBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.products.add_batches(cmd.batches)
         uow.commit()
 
 
@@ -40,6 +50,19 @@ def allocate(
         uow.commit()
 
 
+def allocate_many(
+    cmd: commands.AllocateMany,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    lines = [OrderLine(orderid, cmd.sku, qty) for orderid, qty in cmd.lines]
+    with uow:
+        product = uow.products.get(sku=cmd.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {cmd.sku}")
+        product.allocate_many(lines)
+        uow.commit()
+
+
 def reallocate(
     event: events.Deallocated,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -60,6 +83,7 @@ def change_batch_quantity(
 # pylint: disable=unused-argument
 
 
+@background
 def send_out_of_stock_notification(
     event: events.OutOfStock,
     notifications: notifications.AbstractNotifications,
@@ -70,51 +94,78 @@ def send_out_of_stock_notification(
     )
 
 
-def publish_allocated_event(
-    event: events.Allocated,
-    publish: Callable,
-):
-    publish("line_allocated", event)
-
-
-def add_allocation_to_read_model(
-    event: events.Allocated,
+def allocations_view_changes(
+    allocation_events: List[Union[events.Allocated, events.Deallocated]],
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Collapses a run of Allocated and Deallocated events into the
+    allocations_view rows to delete, by orderid and sku, and the rows to
+    insert afterwards, with the same result as applying them one by one.
+    """
+    deletes = {}  # type: Dict[Tuple[str, str], dict]
+    inserts = {}  # type: Dict[Tuple[str, str], List[dict]]
+    for event in allocation_events:
+        key = (event.orderid, event.sku)
+        if isinstance(event, events.Deallocated):
+            deletes[key] = dict(orderid=event.orderid, sku=event.sku)
+            inserts.pop(key, None)
+        else:
+            inserts.setdefault(key, []).append(
+                dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
+            )
+    return list(deletes.values()), [row for rows in inserts.values() for row in rows]
+
+
+@batched
+def update_allocations_view(
+    allocation_events: List[Union[events.Allocated, events.Deallocated]],
     uow: unit_of_work.SqlAlchemyUnitOfWork,
 ):
+    deletes, inserts = allocations_view_changes(allocation_events)
     with uow:
-        uow.session.execute(
-            """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """,
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
-        )
+        if deletes:
+            uow.session.execute(
+                """
+                DELETE FROM allocations_view
+                WHERE orderid = :orderid AND sku = :sku
+                """,
+                deletes,
+            )
+        if inserts:
+            uow.session.execute(
+                """
+                INSERT INTO allocations_view (orderid, sku, batchref)
+                VALUES (:orderid, :sku, :batchref)
+                """,
+                inserts,
+            )
         uow.commit()
 
 
-def remove_allocation_from_read_model(
-    event: events.Deallocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+@batched
+def invalidate_cached_allocations(
+    allocation_events: List[Union[events.Allocated, events.Deallocated]],
+    views_cache: views_cache.AbstractViewsCache,
 ):
-    with uow:
-        uow.session.execute(
-            """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """,
-            dict(orderid=event.orderid, sku=event.sku),
-        )
-        uow.commit()
+    # registered after update_allocations_view, so it runs once the view
+    # has changed
+    views_cache.invalidate(*{event.orderid for event in allocation_events})
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [update_allocations_view, invalidate_cached_allocations],
+    events.Deallocated: [
+        update_allocations_view,
+        invalidate_cached_allocations,
+        reallocate,
+    ],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
+    commands.ImportBatches: import_batches,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -1,15 +1,63 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
+import asyncio
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent import futures
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    Type,
+)
+from allocation.adapters import metrics as metrics_
 from allocation.domain import commands, events
-
-if TYPE_CHECKING:
-    from . import unit_of_work
+from . import unit_of_work
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
+# what a batched handler is called with
+EventBatch = List[events.Event]
+
+FOREGROUND = "foreground"
+BACKGROUND = "background"
+
+
+def background(handler: Callable) -> Callable:
+    """
+    Marks an event handler as a side effect. The bus runs it once the
+    foreground cascade is done, or hands it to a background executor.
+    """
+    setattr(handler, "lane", BACKGROUND)
+    return handler
+
+
+def batched(handler: Callable) -> Callable:
+    """
+    Marks a background handler that takes a list: every event it handles
+    from one cascade, in order, in a single call.
+    """
+    setattr(handler, "batched", True)
+    return background(handler)
+
+
+def lane_of(handler: Callable) -> str:
+    return getattr(handler, "lane", FOREGROUND)
+
+
+def is_batched(handler: Callable) -> bool:
+    return getattr(handler, "batched", False)
 
 
 class MessageBus:
@@ -18,38 +66,366 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        metrics: metrics_.AbstractMetrics = None,
+        background: futures.Executor = None,
+        retries: int = 0,
+        backoff: float = 0.01,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.metrics = metrics or metrics_.NullMetrics()
+        self.background = background
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = deque()  # type: Deque[Message]
+        self.deferred = deque()  # type: Deque[Tuple[events.Event, float]]
 
     def handle(self, message: Message):
-        self.queue = [message]
+        self.handle_many([message])
+
+    def handle_many(self, messages: Iterable[Message]):
+        try:
+            # each message's cascade is finished before the next message is
+            # taken, so a failing message can't strand the events of one
+            # that has already committed
+            for message in messages:
+                handled = self.handle_cascade(message)
+                if self.metrics.enabled:
+                    self.metrics.observe("messagebus_cascade_length", handled)
+        finally:
+            # when a message fails, what earlier ones committed still gets
+            # its side effects
+            self.run_deferred()
+
+    def handle_cascade(self, message: Message) -> int:
+        self.queue = deque([message])
+        handled = 0
         while self.queue:
-            message = self.queue.pop(0)
+            if self.metrics.enabled:
+                self.metrics.observe("messagebus_queue_depth", len(self.queue))
+            message = self.queue.popleft()
             if isinstance(message, events.Event):
                 self.handle_event(message)
             elif isinstance(message, commands.Command):
                 self.handle_command(message)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+            handled += 1
+        return handled
 
     def handle_event(self, event: events.Event):
         for handler in self.event_handlers[type(event)]:
+            if lane_of(handler) == BACKGROUND:
+                continue
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
+                self._call_with_retries(handler, event)
                 self.queue.extend(self.uow.collect_new_events())
             except Exception:
                 logger.exception("Exception handling event %s", event)
                 continue
+        # background handlers only see events the foreground has handled
+        self.deferred.append((event, time.perf_counter()))
 
     def handle_command(self, command: commands.Command):
         logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
+            self._call_with_retries(handler, command)
             self.queue.extend(self.uow.collect_new_events())
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
+
+    def run_deferred(self):
+        calls = _deferred_calls(self.event_handlers, self.deferred)
+        self.deferred.clear()
+        for handler, message, deferred_at in calls:
+            if self.background is None:
+                self._call_deferred(handler, message, deferred_at)
+            else:
+                self.background.submit(
+                    self._call_deferred, handler, message, deferred_at
+                )
+
+    def _call_deferred(self, handler: Callable, message, deferred_at: float):
+        try:
+            logger.debug("handling event %s with handler %s", message, handler)
+            _observe_lag(self.metrics, handler, deferred_at)
+            self._call(handler, message)
+        except Exception:
+            logger.exception("Exception handling event %s", message)
+
+    def _call_with_retries(self, handler: Callable, message: Message):
+        attempt = 0
+        while True:
+            try:
+                return self._call(handler, message)
+            except unit_of_work.ConcurrentUpdate:
+                if attempt >= self.retries:
+                    raise
+                logger.info("retrying %s after a concurrent update", message)
+                self.metrics.increment(
+                    "messagebus_retries_total", {"message": type(message).__name__}
+                )
+                time.sleep(_jittered(self.backoff, attempt))
+                attempt += 1
+
+    def _call(self, handler: Callable, message: Union[Message, EventBatch]):
+        if not self.metrics.enabled:
+            handler(message)
+            return
+        labels = _labels(handler, message)
+        self.metrics.increment("messagebus_messages_total", labels)
+        start = time.perf_counter()
+        try:
+            handler(message)
+        except Exception:
+            self.metrics.increment("messagebus_exceptions_total", labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("messagebus_handler_seconds", elapsed, labels)
+
+
+class AsyncMessageBus:
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractAsyncUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable[..., Awaitable]]],
+        command_handlers: Dict[Type[commands.Command], Callable[..., Awaitable]],
+        metrics: metrics_.AbstractMetrics = None,
+        retries: int = 0,
+        backoff: float = 0.01,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.metrics = metrics or metrics_.NullMetrics()
+        self.retries = retries
+        self.backoff = backoff
+
+    async def handle(self, message: Message):
+        await self.handle_many([message])
+
+    async def handle_many(self, messages: Iterable[Message]):
+        # many messages can be in flight on one event loop at the same time,
+        # so each call works through its own queue
+        queue = deque()  # type: Deque[Message]
+        deferred = []  # type: List[Tuple[events.Event, float]]
+        try:
+            # as for MessageBus, one message's cascade at a time
+            for message in messages:
+                queue.append(message)
+                handled = await self.handle_cascade(queue, deferred)
+                if self.metrics.enabled:
+                    self.metrics.observe("messagebus_cascade_length", handled)
+        finally:
+            # as for MessageBus, side effects of what committed still run
+            await self.run_deferred(deferred)
+
+    async def handle_cascade(
+        self, queue: Deque[Message], deferred: List[Tuple[events.Event, float]]
+    ) -> int:
+        handled = 0
+        while queue:
+            if self.metrics.enabled:
+                self.metrics.observe("messagebus_queue_depth", len(queue))
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                queue.extend(await self.handle_event(message))
+                deferred.append((message, time.perf_counter()))
+            elif isinstance(message, commands.Command):
+                queue.extend(await self.handle_command(message))
+            else:
+                raise Exception(f"{message} was not an Event or Command")
+            handled += 1
+        return handled
+
+    async def handle_event(self, event: events.Event) -> List[Message]:
+        new_events = []  # type: List[Message]
+        for handler in self.event_handlers[type(event)]:
+            if lane_of(handler) == BACKGROUND:
+                continue
+            try:
+                logger.debug("handling event %s with handler %s", event, handler)
+                await self._call_with_retries(handler, event)
+                new_events.extend(self.uow.collect_new_events())
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+                continue
+        return new_events
+
+    async def handle_command(self, command: commands.Command) -> List[Message]:
+        logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handlers[type(command)]
+            await self._call_with_retries(handler, command)
+            return list(self.uow.collect_new_events())
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
+
+    async def run_deferred(self, deferred: Iterable[Tuple[events.Event, float]]):
+        for handler, message, deferred_at in _deferred_calls(
+            self.event_handlers, deferred
+        ):
+            try:
+                logger.debug("handling event %s with handler %s", message, handler)
+                _observe_lag(self.metrics, handler, deferred_at)
+                await self._call(handler, message)
+            except Exception:
+                logger.exception("Exception handling event %s", message)
+
+    async def _call_with_retries(
+        self, handler: Callable[..., Awaitable], message: Message
+    ):
+        attempt = 0
+        while True:
+            try:
+                return await self._call(handler, message)
+            except unit_of_work.ConcurrentUpdate:
+                if attempt >= self.retries:
+                    raise
+                logger.info("retrying %s after a concurrent update", message)
+                self.metrics.increment(
+                    "messagebus_retries_total", {"message": type(message).__name__}
+                )
+                await asyncio.sleep(_jittered(self.backoff, attempt))
+                attempt += 1
+
+    async def _call(
+        self, handler: Callable[..., Awaitable], message: Union[Message, EventBatch]
+    ):
+        if not self.metrics.enabled:
+            await handler(message)
+            return
+        labels = _labels(handler, message)
+        self.metrics.increment("messagebus_messages_total", labels)
+        start = time.perf_counter()
+        try:
+            await handler(message)
+        except Exception:
+            self.metrics.increment("messagebus_exceptions_total", labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("messagebus_handler_seconds", elapsed, labels)
+
+
+class ShardedMessageBus:
+    """
+    Runs messages for different SKUs in parallel. Each SKU always goes to the
+    same shard, a single worker thread with its own MessageBus and unit of
+    work, so messages for one SKU are still handled one at a time and in
+    order.
+    """
+
+    def __init__(
+        self,
+        buses: List[MessageBus],
+        uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        self.buses = buses
+        self.uow = uow  # for looking up batch references
+        self.workers = [
+            futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{i}")
+            for i in range(len(buses))
+        ]
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._lookup_lock = threading.Lock()
+
+    def handle(self, message: Message):
+        self.dispatch(message).result()
+
+    def handle_many(self, messages: Iterable[Message]):
+        pending = [self.dispatch(message) for message in messages]
+        futures.wait(pending)
+        for future in pending:
+            future.result()
+
+    def dispatch(self, message: Message) -> futures.Future:
+        shard = self.shard_for(message)
+        return self.workers[shard].submit(self.buses[shard].handle, message)
+
+    def shard_for(self, message: Message) -> int:
+        sku = self._sku_of(message)
+        if sku is None:
+            return 0
+        return zlib.crc32(sku.encode()) % len(self.buses)
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+
+    def _sku_of(self, message: Message) -> Optional[str]:
+        if isinstance(message, commands.ChangeBatchQuantity):
+            return self._sku_for_batchref(message.ref)
+        if isinstance(message, commands.CreateBatch):
+            self._skus_by_batchref[message.ref] = message.sku
+        return getattr(message, "sku", None)
+
+    def _sku_for_batchref(self, batchref: str) -> Optional[str]:
+        if batchref not in self._skus_by_batchref:
+            with self._lookup_lock, self.uow:
+                product = self.uow.products.get_by_batchref(batchref)
+            if product is None:
+                return None
+            self._skus_by_batchref[batchref] = product.sku
+        return self._skus_by_batchref[batchref]
+
+
+def _deferred_calls(
+    event_handlers: Dict[Type[events.Event], List[Callable]],
+    deferred: Iterable[Tuple[events.Event, float]],
+) -> List[Tuple[Callable, Union[events.Event, EventBatch], float]]:
+    """
+    Works out the background calls for a cascade's events, in order: one
+    per event for most handlers, and one for each batched handler, made
+    with the list of its events when it would first have been called.
+    """
+    calls = []  # type: List[Tuple[Callable, Union[events.Event, EventBatch], float]]
+    batches = {}  # type: Dict[Callable, EventBatch]
+    for event, deferred_at in deferred:
+        for handler in event_handlers[type(event)]:
+            if lane_of(handler) != BACKGROUND:
+                continue
+            if not is_batched(handler):
+                calls.append((handler, event, deferred_at))
+                continue
+            # bootstrap wraps a handler once per event type it handles
+            key = getattr(handler, "__wrapped__", handler)
+            if key not in batches:
+                batches[key] = []
+                calls.append((handler, batches[key], deferred_at))
+            batches[key].append(event)
+    return calls
+
+
+def _observe_lag(
+    metrics: metrics_.AbstractMetrics, handler: Callable, deferred_at: float
+):
+    # how far side effects such as the read model trail the cascade
+    if metrics.enabled:
+        metrics.observe(
+            "messagebus_deferred_lag_seconds",
+            time.perf_counter() - deferred_at,
+            {"handler": getattr(handler, "__name__", repr(handler))},
+        )
+
+
+def _jittered(backoff: float, attempt: int) -> float:
+    # full jitter, so allocators that collided don't collide again in step
+    return random.uniform(0, backoff * 2**attempt)
+
+
+def _labels(handler: Callable, message) -> Dict[str, str]:
+    if isinstance(message, list):
+        name = ",".join(sorted({type(m).__name__ for m in message}))
+    else:
+        name = type(message).__name__
+    return {
+        "handler": getattr(handler, "__name__", repr(handler)),
+        "message": name,
+    }
@@ -1,17 +1,46 @@
-# pylint: disable=attribute-defined-outside-init
+# pylint: disable=attribute-defined-outside-init, import-outside-toplevel
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple, TYPE_CHECKING
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.orm import exc as orm_exc, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.session import Session
 
-
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import metrics as metrics_, orm, outbox, repository
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentUpdate(Exception):
+    """Another transaction changed the product first; safe to retry."""
+
+
+# serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
+
+def is_concurrent_update(error: Exception) -> bool:
+    if isinstance(error, orm_exc.StaleDataError):
+        return True
+    orig = getattr(error, "orig", None)
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    return sqlstate in RETRYABLE_SQLSTATES
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    metrics = metrics_.NullMetrics()  # type: metrics_.AbstractMetrics
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -20,12 +49,20 @@ class AbstractUnitOfWork(abc.ABC):
         self.rollback()
 
     def commit(self):
-        self._commit()
+        if not self.metrics.enabled:
+            self._commit()
+            return
+        start = time.perf_counter()
+        try:
+            self._commit()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("uow_commit_seconds", elapsed)
 
     def collect_new_events(self):
         for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+            new_events, product.events = product.events, []
+            yield from new_events
 
     @abc.abstractmethod
     def _commit(self):
@@ -36,29 +73,362 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
-)
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long callers wait to check out a connection."""
+
+    metrics = metrics_.NullMetrics()  # type: metrics_.AbstractMetrics
+
+    def _do_get(self):
+        if not self.metrics.enabled:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.observe(
+                "db_pool_checkout_seconds",
+                time.perf_counter() - start,
+                {"pool": self._orig_logging_name},
+            )
+
+
+def report_pool_metrics(metrics: metrics_.AbstractMetrics):
+    TimedQueuePool.metrics = metrics
+
+
+# the write model relies on repeatable reads to spot concurrent updates;
+# the read model only ever needs committed rows
+ISOLATION_LEVELS = {
+    "write": "REPEATABLE READ",
+    "read": "READ COMMITTED",
+    "replica": "READ COMMITTED",
+}
+
+_session_factories = {}  # type: Dict[str, sessionmaker]
+_session_factories_lock = threading.Lock()
+
+
+def session_factory_for(role: str) -> sessionmaker:
+    # engines are built on first use, so importing this module doesn't touch
+    # the database, and once per process, so forked workers get their own
+    with _session_factories_lock:
+        if role not in _session_factories:
+            connect_args = {}
+            if role == "replica":
+                # an unreachable replica should fail fast, not hang its caller
+                settings = config.get_replica_settings()
+                connect_args["connect_timeout"] = settings["connect_timeout"]
+            engine = create_engine(
+                config.get_postgres_uri(role=role),
+                isolation_level=ISOLATION_LEVELS[role],
+                poolclass=TimedQueuePool,
+                pool_logging_name=role,
+                connect_args=connect_args,
+                **config.get_pool_settings(role),
+            )
+            _session_factories[role] = sessionmaker(bind=engine)
+        return _session_factories[role]
+
+
+def default_session_factory() -> sessionmaker:
+    return session_factory_for("write")
+
+
+def _forget_inherited_engines():
+    global _session_factories_lock  # pylint: disable=global-statement
+    _session_factories_lock = threading.Lock()
+    for factory in _session_factories.values():
+        # leave the parent's connections open for the parent to use
+        factory.kw["bind"].dispose(close=False)
+    _session_factories.clear()
+
+
+os.register_at_fork(after_in_child=_forget_inherited_engines)
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=None,
+        cache: repository.ProductCache = None,
+        loading: str = None,
+        role: str = "write",
+    ):
         self.session_factory = session_factory
+        self.role = role
+        self.cache = cache
+        self.loading = loading or config.get_product_loading_strategy()
+        self.skus_by_batchref = repository.BatchrefIndex()
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        session_factory = self._session_factory()
+        if self.cache is None:
+            self.session = session_factory()  # type: Session
+        else:
+            # cached products have to stay readable once the session closes
+            self.session = session_factory(expire_on_commit=False)
+        self.products = repository.SqlAlchemyRepository(
+            self.session,
+            self.cache,
+            self.metrics,
+            self.loading,
+            self.skus_by_batchref,
+        )
+        self._outboxed = set()  # type: Set[int]
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
         self.session.close()
 
+    # looked up each time rather than kept, so a forked worker gets its own
+    def _session_factory(self) -> sessionmaker:
+        return self.session_factory or session_factory_for(self.role)
+
     def _commit(self):
-        self.session.commit()
+        messages = outbox.pending_messages(self.products.seen, self._outboxed)
+        if messages:
+            self.session.execute(orm.outbox.insert(), messages)
+        for product in self.products.seen:
+            # before committing, while the batches are still loaded
+            self.products.remember_batchrefs(product)
+        try:
+            self.session.commit()
+        except (orm_exc.StaleDataError, exc.DBAPIError) as e:
+            if not is_concurrent_update(e):
+                raise
+            raise ConcurrentUpdate(str(e)) from e
+        if self.cache is not None:
+            self.cache.checkin(self.products.seen)
 
     def rollback(self):
         self.session.rollback()
+
+
+def postgres_replica_lag(session: Session) -> float:
+    # how long ago the replica replayed the primary's last transaction; an
+    # idle primary makes a replica look behind, which only costs a fallback
+    return session.execute(
+        text(
+            "SELECT CASE WHEN pg_is_in_recovery() THEN COALESCE(EXTRACT(EPOCH"
+            " FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END"
+        )
+    ).scalar()
+
+
+class ReadOnlyUnitOfWork:
+    """
+    A session for views and read endpoints, never committed. It's on the
+    replica when there is one and it's no more than max_lag seconds behind,
+    otherwise on the primary's read engine. The lag is checked at most once
+    every lag_check_interval seconds. With use_replica=False it always reads
+    from the primary, for reads whose results outlive the lag, like cache
+    fills. One instance can be shared between threads.
+    """
+
+    metrics = metrics_.NullMetrics()  # type: metrics_.AbstractMetrics
+
+    def __init__(
+        self,
+        primary_factory: sessionmaker = None,
+        replica_factory: sessionmaker = None,
+        max_lag: float = None,
+        lag_check_interval: float = None,
+        replica_lag: Callable[[Session], float] = postgres_replica_lag,
+        use_replica: bool = None,
+    ):
+        settings = config.get_replica_settings()
+        self.primary_factory = primary_factory
+        self.replica_factory = replica_factory
+        if use_replica is None:
+            use_replica = replica_factory is not None or settings["enabled"]
+        self.use_replica = use_replica
+        self.max_lag = settings["max_lag"] if max_lag is None else max_lag
+        if lag_check_interval is None:
+            lag_check_interval = settings["lag_check_interval"]
+        self.lag_check_interval = lag_check_interval
+        self.replica_lag = replica_lag
+        self._lag = None  # type: Optional[float]
+        self._lag_checked_at = float("-inf")
+        self._lag_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self) -> Session:
+        return self._local.session
+
+    @property
+    def target(self) -> str:
+        return self._local.target
+
+    def __enter__(self) -> ReadOnlyUnitOfWork:
+        if self._replica_is_current():
+            self._local.target, factory = "replica", self._replica_factory()
+        else:
+            self._local.target, factory = "primary", self._primary_factory()
+        self._local.session = factory()
+        self._local.entered_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.session.rollback()
+        self.session.close()
+        self.metrics.observe(
+            "db_read_seconds",
+            time.perf_counter() - self._local.entered_at,
+            {"target": self.target},
+        )
+
+    # looked up each time rather than kept, so a forked worker gets its own
+    def _primary_factory(self) -> sessionmaker:
+        return self.primary_factory or session_factory_for("read")
+
+    def _replica_factory(self) -> sessionmaker:
+        return self.replica_factory or session_factory_for("replica")
+
+    def _replica_is_current(self) -> bool:
+        if not self.use_replica:
+            return False
+        # one thread checks the lag while the others go on with the last one
+        if self._lag_check_due() and self._lag_lock.acquire(blocking=False):
+            try:
+                if self._lag_check_due():
+                    self._lag_checked_at = time.monotonic()
+                    self._lag = self._check_lag()
+            finally:
+                self._lag_lock.release()
+        lag = self._lag
+        if lag is None or lag > self.max_lag:
+            self.metrics.increment("db_replica_fallbacks_total")
+            return False
+        return True
+
+    def _lag_check_due(self) -> bool:
+        return time.monotonic() - self._lag_checked_at >= self.lag_check_interval
+
+    def _check_lag(self) -> Optional[float]:
+        try:
+            with self._replica_factory()() as session:
+                lag = float(self.replica_lag(session))
+        except exc.DBAPIError:
+            logger.exception("couldn't check the replica's lag")
+            return None
+        self.metrics.observe("db_replica_lag_seconds", lag)
+        return lag
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    metrics = metrics_.NullMetrics()  # type: metrics_.AbstractMetrics
+
+    @property
+    @abc.abstractmethod
+    def products(self) -> repository.AbstractAsyncRepository:
+        raise NotImplementedError
+
+    async def __aenter__(self) -> AbstractAsyncUnitOfWork:
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    async def commit(self):
+        if not self.metrics.enabled:
+            await self._commit()
+            return
+        start = time.perf_counter()
+        try:
+            await self._commit()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("uow_commit_seconds", elapsed)
+
+    def collect_new_events(self):
+        for product in self.products.seen:
+            new_events, product.events = product.events, []
+            yield from new_events
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_session_factory():
+    # built on first use, so importing this module doesn't need asyncpg
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    return sessionmaker(
+        bind=create_async_engine(
+            config.get_async_postgres_uri(),
+            isolation_level="REPEATABLE READ",
+            **config.get_pool_settings("write"),
+        ),
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+
+
+# a task's session, its repository and the ids of events it has outboxed
+_TaskState = Tuple["AsyncSession", repository.AsyncSqlAlchemyRepository, Set[int]]
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    # one instance is shared by every task on the event loop, so the session
+    # and repository are kept per task rather than on the instance
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self._current = contextvars.ContextVar(
+            f"uow-{id(self)}", default=None
+        )  # type: contextvars.ContextVar[Optional[_TaskState]]
+
+    @property
+    def session(self) -> AsyncSession:
+        return self._state()[0]
+
+    @property
+    def products(self) -> repository.AsyncSqlAlchemyRepository:
+        return self._state()[1]
+
+    @property
+    def _outboxed(self) -> Set[int]:
+        return self._state()[2]
+
+    def _state(self) -> _TaskState:
+        state = self._current.get()
+        if state is None:
+            raise RuntimeError("only available inside `async with uow`")
+        return state
+
+    async def __aenter__(self):
+        if self.session_factory is None:
+            self.session_factory = default_async_session_factory()
+        session = self.session_factory()
+        repo = repository.AsyncSqlAlchemyRepository(session)
+        self._current.set((session, repo, set()))
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    def collect_new_events(self):
+        if self._current.get() is not None:
+            yield from super().collect_new_events()
+
+    async def _commit(self):
+        messages = outbox.pending_messages(self.products.seen, self._outboxed)
+        if messages:
+            await self.session.execute(orm.outbox.insert(), messages)
+        try:
+            await self.session.commit()
+        except (orm_exc.StaleDataError, exc.DBAPIError) as e:
+            if not is_concurrent_update(e):
+                raise
+            raise ConcurrentUpdate(str(e)) from e
+
+    async def rollback(self):
+        await self.session.rollback()
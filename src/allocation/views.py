@@ -1,7 +1,13 @@
+from typing import Iterable, Iterator
+from sqlalchemy import bindparam, text
+from allocation.adapters import views_cache
 from allocation.service_layer import unit_of_work
 
+# orderids per query, under SQLite's oldest limit on bound parameters
+QUERY_CHUNK_SIZE = 500
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+
+def allocations(orderid: str, uow: unit_of_work.ReadOnlyUnitOfWork):
     with uow:
         results = uow.session.execute(
             """
@@ -9,4 +15,49 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             """,
             dict(orderid=orderid),
         )
-    return [dict(r) for r in results]
+        return [dict(r) for r in results]
+
+
+def allocations_for(
+    orderids: Iterable[str], uow: unit_of_work.ReadOnlyUnitOfWork
+) -> Iterator[dict]:
+    """
+    Every allocation of the given orders, one query per QUERY_CHUNK_SIZE of
+    them, with rows streamed from the database as they're consumed.
+    """
+    query = text(
+        """
+        SELECT orderid, sku, batchref FROM allocations_view
+        WHERE orderid IN :orderids ORDER BY orderid, sku
+        """
+    ).bindparams(bindparam("orderids", expanding=True))
+    orderids = list(dict.fromkeys(orderids))
+    with uow:
+        for start in range(0, len(orderids), QUERY_CHUNK_SIZE):
+            results = uow.session.execute(
+                query,
+                dict(orderids=orderids[start : start + QUERY_CHUNK_SIZE]),
+                execution_options={"stream_results": True},
+            )
+            for row in results:
+                yield dict(row)
+
+
+def cached_allocations(
+    orderid: str,
+    uow: unit_of_work.ReadOnlyUnitOfWork,
+    cache: views_cache.AbstractViewsCache,
+) -> views_cache.Entry:
+    """
+    The order's allocations from the cache, or read with uow and cached.
+    What's read is kept until invalidated or expired, so uow should read
+    from the primary rather than from a replica that may be behind.
+    """
+    entry = cache.get(orderid)
+    if entry is None:
+        entry = views_cache.Entry.of(allocations(orderid, uow))
+        # orders are polled for before their allocation reaches the view,
+        # so "nothing yet" isn't worth keeping
+        if entry.rows:
+            cache.set(orderid, entry)
+    return entry
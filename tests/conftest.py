@@ -11,6 +11,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
+from allocation.adapters import migrations
 from allocation.adapters.orm import metadata, start_mappers
 from allocation import config
 
@@ -56,7 +57,8 @@ def wait_for_redis_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri(), isolation_level="SERIALIZABLE")
     wait_for_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    # an existing database may predate the current schema
+    migrations.migrate(engine)
     return engine
 
 
@@ -1,4 +1,6 @@
+import json
 import requests
+from tenacity import Retrying, stop_after_delay, wait_fixed
 from allocation import config
 
 
@@ -25,6 +27,29 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
-def get_allocation(orderid):
+def get_allocation(orderid, etag=None):
     url = config.get_api_url()
-    return requests.get(f"{url}/allocations/{orderid}")
+    headers = {"If-None-Match": etag} if etag else {}
+    return requests.get(f"{url}/allocations/{orderid}", headers=headers)
+
+
+def post_query(body):
+    url = config.get_api_url()
+    return requests.post(f"{url}/allocations/query", json=body)
+
+
+def post_to_query_allocations(orderids):
+    r = post_query({"orderids": orderids})
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
+
+
+def wait_for_allocation(orderid):
+    # the read model is updated in the background, after /allocate returns
+    for attempt in Retrying(
+        stop=stop_after_delay(3), wait=wait_fixed(0.1), reraise=True
+    ):
+        with attempt:
+            r = get_allocation(orderid)
+            assert r.ok
+    return r
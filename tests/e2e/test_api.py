@@ -18,8 +18,7 @@ def test_happy_path_returns_202_and_batch_is_allocated():
     r = api_client.post_to_allocate(orderid, sku, qty=3)
     assert r.status_code == 202
 
-    r = api_client.get_allocation(orderid)
-    assert r.ok
+    r = api_client.wait_for_allocation(orderid)
     assert r.json() == [
         {"sku": sku, "batchref": earlybatch},
     ]
@@ -37,3 +36,38 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_unchanged_allocations_are_not_sent_again():
+    orderid, sku, batch = random_orderid(), random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(orderid, sku, qty=3)
+    etag = api_client.wait_for_allocation(orderid).headers["ETag"]
+
+    r = api_client.get_allocation(orderid, etag=etag)
+    assert r.status_code == 304
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_queries_many_orders_at_once():
+    sku, batch = random_sku(), random_batchref()
+    orderids = [random_orderid(str(i)) for i in range(3)]
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    for orderid in orderids:
+        api_client.post_to_allocate(orderid, sku, qty=3)
+    api_client.wait_for_allocation(orderids[-1])
+
+    rows = api_client.post_to_query_allocations(orderids + [random_orderid()])
+    assert sorted(row["orderid"] for row in rows) == sorted(orderids)
+    assert all(row["batchref"] == batch for row in rows)
+
+
+@pytest.mark.usefixtures("restart_api")
+@pytest.mark.parametrize("body", [["o1"], {"orderids": "o1"}, {"orderids": [1]}])
+def test_malformed_queries_are_rejected(body):
+    r = api_client.post_query(body)
+    assert r.status_code == 400
+    assert r.json()["message"] == "orderids must be a list of strings"
@@ -16,7 +16,7 @@ def test_change_batch_quantity_leading_to_reallocation():
     api_client.post_to_add_batch(later_batch, sku, qty=10, eta="2011-01-02")
     r = api_client.post_to_allocate(orderid, sku, 10)
     assert r.ok
-    response = api_client.get_allocation(orderid)
+    response = api_client.wait_for_allocation(orderid)
     assert response.json()[0]["batchref"] == earlier_batch
 
     subscription = redis_client.subscribe_to("line_allocated")
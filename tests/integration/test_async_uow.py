@@ -0,0 +1,90 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+from unittest import mock
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def async_sqlite_session_factory():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    asyncio.run(create_tables())
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@pytest.fixture
+def async_sqlite_bus(async_sqlite_session_factory):
+    bus = bootstrap.bootstrap_async(
+        start_orm=True,
+        uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory),
+        notifications=mock.Mock(),
+    )
+    yield bus
+    clear_mappers()
+
+
+async def get_allocations(session_factory, orderid):
+    async with session_factory() as session:
+        rows = await session.execute(
+            "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid",
+            dict(orderid=orderid),
+        )
+        return [tuple(row) for row in rows]
+
+
+def test_uow_can_retrieve_a_batch_and_allocate_to_it(async_sqlite_bus):
+    uow = async_sqlite_bus.uow
+
+    async def allocate():
+        await async_sqlite_bus.handle(
+            commands.CreateBatch("batch1", "HIPSTER-WORKBENCH", 100, None)
+        )
+        async with uow:
+            product = await uow.products.get(sku="HIPSTER-WORKBENCH")
+            product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+            await uow.commit()
+        async with uow:
+            product = await uow.products.get_by_batchref("batch1")
+            return product.batches[0].available_quantity
+
+    assert asyncio.run(allocate()) == 90
+
+
+def test_rolls_back_uncommitted_work_by_default(async_sqlite_bus):
+    uow = async_sqlite_bus.uow
+
+    async def add_without_committing():
+        async with uow:
+            uow.products.add(model.Product("MEDIUM-PLINTH", batches=[]))
+        async with uow:
+            return await uow.products.get("MEDIUM-PLINTH")
+
+    assert asyncio.run(add_without_committing()) is None
+
+
+def test_reallocates_and_updates_read_model(
+    async_sqlite_bus, async_sqlite_session_factory
+):
+    async def run():
+        await async_sqlite_bus.handle_many(
+            [
+                commands.CreateBatch("b1", "sku1", 50, None),
+                commands.CreateBatch("b2", "sku1", 50, None),
+                commands.Allocate("o1", "sku1", 40),
+                commands.ChangeBatchQuantity("b1", 10),
+            ]
+        )
+        return await get_allocations(async_sqlite_session_factory, "o1")
+
+    assert asyncio.run(run()) == [("sku1", "b2")]
@@ -0,0 +1,53 @@
+import io
+from datetime import date
+import pytest
+from allocation import bootstrap
+from allocation.entrypoints import bulk_import
+from allocation.service_layer import unit_of_work
+from ..unit.test_handlers import FakeNotifications
+from .test_uow import insert_batch
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+CSV = """ref,sku,qty,eta
+b1,GREEN-CHAIR,10,
+b2,RED-CHAIR,20,2011-01-02
+b3,GREEN-CHAIR,30,
+"""
+
+NDJSON = """{"ref": "b1", "sku": "GREEN-CHAIR", "qty": 10, "eta": null}
+{"ref": "b2", "sku": "RED-CHAIR", "qty": 20, "eta": "2011-01-02"}
+
+{"ref": "b3", "sku": "GREEN-CHAIR", "qty": 30}
+"""
+
+
+@pytest.mark.parametrize("fmt, text", [("csv", CSV), ("ndjson", NDJSON)])
+def test_reads_csv_and_ndjson(fmt, text):
+    assert list(bulk_import.read_batches(io.StringIO(text), fmt)) == [
+        ("b1", "GREEN-CHAIR", 10, None),
+        ("b2", "RED-CHAIR", 20, date(2011, 1, 2)),
+        ("b3", "GREEN-CHAIR", 30, None),
+    ]
+
+
+def test_imports_batches_in_chunks(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b0", "GREEN-CHAIR", 5, None, product_version=3)
+    session.commit()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=FakeNotifications(),
+    )
+
+    batches = bulk_import.read_batches(io.StringIO(CSV), "csv")
+    assert bulk_import.import_batches(bus, batches, chunk_size=2) == 3
+
+    assert list(
+        session.execute("SELECT sku, version_number FROM products ORDER BY sku")
+    ) == [("GREEN-CHAIR", 5), ("RED-CHAIR", 1)]
+    with bus.uow:
+        product = bus.uow.products.get("GREEN-CHAIR")
+        assert sorted(b.reference for b in product.batches) == ["b0", "b1", "b3"]
+        assert bus.uow.products.get_by_batchref("b2").sku == "RED-CHAIR"
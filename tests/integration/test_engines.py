@@ -0,0 +1,164 @@
+import threading
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import sessionmaker
+from allocation import config
+from allocation.adapters import orm
+from allocation.adapters.metrics import InMemoryMetrics, NullMetrics
+from allocation.service_layer import unit_of_work
+
+
+def test_read_and_write_models_get_their_own_engines():
+    write = unit_of_work.session_factory_for("write").kw["bind"]
+    read = unit_of_work.session_factory_for("read").kw["bind"]
+    assert write is not read
+    assert write.dialect.isolation_level == "REPEATABLE READ"
+    assert read.dialect.isolation_level == "READ COMMITTED"
+    assert isinstance(write.pool, unit_of_work.TimedQueuePool)
+
+
+def test_pool_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_READ_POOL_SIZE", "40")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+    assert config.get_pool_settings("write")["pool_size"] == 20
+    assert config.get_pool_settings("read")["pool_size"] == 40
+    assert config.get_pool_settings("read")["pool_pre_ping"] is False
+
+
+def test_a_forked_child_builds_its_own_engine():
+    parent = unit_of_work.session_factory_for("write")
+    unit_of_work._forget_inherited_engines()  # what os.fork() runs in the child
+    assert unit_of_work.session_factory_for("write") is not parent
+
+
+def test_a_unit_of_work_from_before_the_fork_uses_the_childs_engine():
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    parent = uow._session_factory()
+    unit_of_work._forget_inherited_engines()
+    assert uow._session_factory() is unit_of_work.session_factory_for("write")
+    assert uow._session_factory() is not parent
+
+
+def test_reports_pool_checkout_wait(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=unit_of_work.TimedQueuePool,
+        pool_logging_name="write",
+    )
+    metrics = InMemoryMetrics()
+    unit_of_work.report_pool_metrics(metrics)
+    try:
+        with engine.connect():
+            pass
+    finally:
+        unit_of_work.report_pool_metrics(NullMetrics())
+    labels = (("pool", "write"),)
+    assert metrics.histograms["db_pool_checkout_seconds", labels].count == 1
+
+
+def test_replica_connection_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv("DB_HOST", "primary")
+    monkeypatch.setenv("DB_REPLICA_HOST", "replica")
+    assert "@replica:5432/" in config.get_postgres_uri(role="replica")
+    assert "@primary:5432/" in config.get_postgres_uri(role="read")
+    assert config.get_replica_settings()["enabled"]
+
+
+def sqlite_factory(path, orderid):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            orm.allocations_view.insert(),
+            dict(orderid=orderid, sku="s", batchref="b"),
+        )
+    return sessionmaker(bind=engine)
+
+
+def read_uow(tmp_path, lag, **kwargs):
+    return unit_of_work.ReadOnlyUnitOfWork(
+        primary_factory=sqlite_factory(tmp_path / "primary.db", "from-primary"),
+        replica_factory=sqlite_factory(tmp_path / "replica.db", "from-replica"),
+        replica_lag=lag,
+        **kwargs,
+    )
+
+
+def read_from(uow):
+    with uow:
+        return uow.session.execute("SELECT orderid FROM allocations_view").scalar()
+
+
+def test_reads_from_the_replica_while_it_keeps_up(tmp_path):
+    uow = read_uow(tmp_path, lambda session: 0.5, max_lag=1)
+    assert read_from(uow) == "from-replica"
+
+
+def test_falls_back_to_the_primary_when_the_replica_lags(tmp_path):
+    lags = [0.5, 10.0]
+    uow = read_uow(
+        tmp_path, lambda session: lags.pop(0), max_lag=1, lag_check_interval=0
+    )
+    uow.metrics = InMemoryMetrics()
+
+    assert read_from(uow) == "from-replica"
+    assert read_from(uow) == "from-primary"
+    assert uow.metrics.counters["db_replica_fallbacks_total", ()] == 1
+    assert uow.metrics.histograms["db_replica_lag_seconds", ()].sum == 10.5
+
+
+def test_checks_the_lag_at_most_once_per_interval(tmp_path):
+    checks = []
+    uow = read_uow(
+        tmp_path, lambda session: checks.append(1) or 0, lag_check_interval=60
+    )
+    for _ in range(3):
+        read_from(uow)
+    assert len(checks) == 1
+
+
+def test_falls_back_to_the_primary_when_the_replica_is_unreachable(tmp_path):
+    def unreachable(session):
+        raise exc.OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    uow = read_uow(tmp_path, unreachable)
+    assert read_from(uow) == "from-primary"
+
+
+def test_reads_go_on_while_the_lag_is_being_checked(tmp_path):
+    checking, replied = threading.Event(), threading.Event()
+
+    def slow_lag(session):
+        checking.set()
+        replied.wait(timeout=5)
+        return 0
+
+    uow = read_uow(tmp_path, slow_lag, lag_check_interval=0)
+    checker = threading.Thread(target=read_from, args=(uow,))
+    checker.start()
+    try:
+        assert checking.wait(timeout=5)
+        # the last known lag is used, and there isn't one yet
+        assert read_from(uow) == "from-primary"
+    finally:
+        replied.set()
+        checker.join()
+
+
+def test_reports_read_latency_per_target(tmp_path):
+    uow = read_uow(tmp_path, lambda session: 0, max_lag=1, lag_check_interval=0)
+    uow.metrics = InMemoryMetrics()
+    read_from(uow)
+    uow.max_lag = -1
+    read_from(uow)
+
+    for target in ("replica", "primary"):
+        labels = (("target", target),)
+        assert uow.metrics.histograms["db_read_seconds", labels].count == 1
+
+
+def test_can_be_kept_on_the_primary(tmp_path):
+    checks = []
+    uow = read_uow(tmp_path, lambda session: checks.append(1) or 0, use_replica=False)
+    assert read_from(uow) == "from-primary"
+    assert not checks
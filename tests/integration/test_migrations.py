@@ -0,0 +1,137 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from allocation.adapters import migrations, orm
+
+# the schema as create_all made it before migrations existed
+OLD_SCHEMA = [
+    "CREATE TABLE order_lines (id INTEGER PRIMARY KEY, sku VARCHAR(255),"
+    " qty INTEGER NOT NULL, orderid VARCHAR(255))",
+    "CREATE TABLE products (sku VARCHAR(255) PRIMARY KEY,"
+    " version_number INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE batches (id INTEGER PRIMARY KEY, reference VARCHAR(255),"
+    " sku VARCHAR(255) REFERENCES products (sku),"
+    " _purchased_quantity INTEGER NOT NULL, eta DATE)",
+    "CREATE TABLE allocations (id INTEGER PRIMARY KEY,"
+    " orderline_id INTEGER REFERENCES order_lines (id),"
+    " batch_id INTEGER REFERENCES batches (id))",
+    "CREATE TABLE allocations_view (orderid VARCHAR(255), sku VARCHAR(255),"
+    " batchref VARCHAR(255))",
+]
+
+
+@pytest.fixture
+def old_db():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO products (sku) VALUES ('LAMP')"))
+        conn.execute(
+            text(
+                "INSERT INTO batches (id, reference, sku, _purchased_quantity)"
+                " VALUES (1, 'b1', 'LAMP', 100), (2, 'b2', 'LAMP', 100)"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO order_lines (id, sku, qty, orderid)"
+                " VALUES (1, 'LAMP', 10, 'o1'), (2, 'LAMP', 5, 'o2')"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO allocations (orderline_id, batch_id)"
+                " VALUES (1, 1), (2, 1)"
+            )
+        )
+    return engine
+
+
+def query_plan(engine, query):
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+    return " ".join(row[-1] for row in rows)
+
+
+def test_brings_an_old_database_up_to_date(old_db):
+    applied = migrations.migrate(old_db)
+    assert [m.version for m in applied] == [m.version for m in migrations.MIGRATIONS]
+
+    with old_db.connect() as conn:
+        allocated = conn.execute(
+            text("SELECT reference, _allocated_quantity FROM batches ORDER BY id")
+        ).all()
+    assert allocated == [("b1", 15), ("b2", 0)]
+    assert "outbox" in inspect(old_db).get_table_names()
+
+
+def test_backfills_in_chunks(old_db):
+    migrations.migrate(old_db, target=1)
+    with old_db.begin() as conn:
+        conn.execute(
+            text(
+                "ALTER TABLE batches"
+                " ADD COLUMN _allocated_quantity INTEGER NOT NULL DEFAULT 0"
+            )
+        )
+    migrations.backfill_allocated_quantity(old_db, chunk_size=1)
+    with old_db.connect() as conn:
+        total = conn.execute(text("SELECT SUM(_allocated_quantity) FROM batches"))
+        assert total.scalar() == 15
+
+
+def test_only_applies_each_migration_once(old_db):
+    migrations.migrate(old_db, target=2)
+    assert migrations.applied_versions(old_db) == [1, 2]
+
+    applied = migrations.migrate(old_db)
+    assert [m.version for m in applied] == [3]
+    assert migrations.migrate(old_db) == []
+
+
+def test_is_a_no_op_on_a_new_database(in_memory_sqlite_db):
+    migrations.migrate(in_memory_sqlite_db)
+    assert migrations.applied_versions(in_memory_sqlite_db) == [1, 2, 3]
+
+
+def test_a_new_database_ends_up_with_the_schema_orm_declares():
+    engine = create_engine("sqlite:///:memory:")
+    migrations.migrate(engine)
+    inspector = inspect(engine)
+    for table in orm.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        assert columns == {column.name for column in table.columns}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        assert indexes == {index.name for index in table.indexes}
+
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (
+            "SELECT sku, batchref FROM allocations_view WHERE orderid = 'o1'",
+            "ix_allocations_view_orderid_sku",
+        ),
+        (
+            "DELETE FROM allocations_view WHERE orderid = 'o1' AND sku = 'LAMP'",
+            "ix_allocations_view_orderid_sku",
+        ),
+        (
+            "SELECT id FROM order_lines WHERE orderid = 'o1' AND sku = 'LAMP'",
+            "ix_order_lines_orderid_sku",
+        ),
+        ("SELECT id FROM batches WHERE sku = 'LAMP'", "ix_batches_sku"),
+        ("SELECT id FROM batches WHERE reference = 'b1'", "ix_batches_reference"),
+        (
+            "SELECT orderline_id FROM allocations WHERE batch_id = 1",
+            "ix_allocations_batch_id_orderline_id",
+        ),
+        (
+            "SELECT batch_id FROM allocations WHERE orderline_id = 1",
+            "ix_allocations_orderline_id",
+        ),
+    ],
+)
+def test_lookups_use_an_index_once_migrated(old_db, query, index):
+    assert index not in query_plan(old_db, query)
+    migrations.migrate(old_db)
+    assert index in query_plan(old_db, query)
@@ -0,0 +1,97 @@
+import json
+import pytest
+from allocation.adapters import outbox
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from .test_uow import insert_batch
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.buffered = []
+
+    def publish(self, channel, message):
+        self.buffered.append((channel, message))
+
+    def execute(self):
+        self.client.round_trips += 1
+        self.client.published.extend(self.buffered)
+
+
+def allocate_in_uow(session_factory, orderid, commit=True):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="RETRO-CLOCK")
+        product.allocate(model.OrderLine(orderid, "RETRO-CLOCK", 1))
+        if commit:
+            uow.commit()
+
+
+def outbox_rows(session):
+    return list(session.execute("SELECT channel, payload FROM outbox ORDER BY id"))
+
+
+def test_writes_integration_events_in_the_same_transaction(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "RETRO-CLOCK", 100, None)
+    session.commit()
+
+    allocate_in_uow(sqlite_session_factory, "o1")
+    allocate_in_uow(sqlite_session_factory, "o2", commit=False)
+
+    [(channel, payload)] = outbox_rows(session)
+    assert channel == "line_allocated"
+    assert json.loads(payload) == {
+        "orderid": "o1",
+        "sku": "RETRO-CLOCK",
+        "qty": 1,
+        "batchref": "b1",
+    }
+
+
+def test_relay_publishes_a_batch_in_one_round_trip(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "RETRO-CLOCK", 100, None)
+    session.commit()
+    for i in range(5):
+        allocate_in_uow(sqlite_session_factory, f"o{i}")
+
+    redis_client = FakeRedis()
+    assert outbox.relay(sqlite_session_factory(), redis_client, batch_size=3) == 3
+    assert outbox.relay(sqlite_session_factory(), redis_client, batch_size=3) == 2
+    assert outbox.relay(sqlite_session_factory(), redis_client, batch_size=3) == 0
+
+    assert redis_client.round_trips == 2
+    orderids = [json.loads(p)["orderid"] for _, p in redis_client.published]
+    assert orderids == ["o0", "o1", "o2", "o3", "o4"]
+    assert outbox_rows(session) == []
+
+
+def test_keeps_messages_if_publishing_fails(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "RETRO-CLOCK", 100, None)
+    session.commit()
+    allocate_in_uow(sqlite_session_factory, "o1")
+
+    class BrokenRedis(FakeRedis):
+        def pipeline(self, transaction=True):
+            raise ConnectionError("redis is down")
+
+    relay_session = sqlite_session_factory()
+    with pytest.raises(ConnectionError):
+        outbox.relay(relay_session, BrokenRedis())
+    relay_session.rollback()
+
+    assert len(outbox_rows(session)) == 1
@@ -0,0 +1,100 @@
+import pytest
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.adapters.repository import ProductCache
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from .test_uow import insert_batch
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def allocate(uow, orderid, sku, qty, commit=True):
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine(orderid, sku, qty))
+        if commit:
+            uow.commit()
+    return product
+
+
+def test_reuses_the_cached_product_while_its_version_matches(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "LAZY-SOFA", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, ProductCache())
+
+    first = allocate(uow, "o1", "LAZY-SOFA", 10)
+    second = allocate(uow, "o2", "LAZY-SOFA", 10)
+
+    assert second is first
+    [batch] = second.batches
+    assert batch.available_quantity == 80
+    [[allocated]] = session.execute("SELECT count(*) FROM allocations")
+    assert allocated == 2
+
+
+def test_reloads_a_product_changed_elsewhere(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "LAZY-SOFA", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, ProductCache())
+    first = allocate(uow, "o1", "LAZY-SOFA", 10)
+
+    # another process allocates against the same product
+    allocate(
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        "o2",
+        "LAZY-SOFA",
+        10,
+    )
+
+    second = allocate(uow, "o3", "LAZY-SOFA", 10)
+    assert second is not first
+    [batch] = second.batches
+    assert batch.available_quantity == 70
+
+
+def test_drops_products_from_uncommitted_work(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "LAZY-SOFA", 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    allocate(uow, "o1", "LAZY-SOFA", 10)
+    assert len(cache) == 1
+
+    allocate(uow, "o2", "LAZY-SOFA", 10, commit=False)
+    assert len(cache) == 0
+
+    product = allocate(uow, "o3", "LAZY-SOFA", 10)
+    [batch] = product.batches
+    assert batch.available_quantity == 80
+
+
+def test_reports_hits_and_misses(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "LAZY-SOFA", 100, None)
+    session.commit()
+    metrics = InMemoryMetrics()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, ProductCache())
+    uow.metrics = metrics
+    for i in range(3):
+        allocate(uow, f"o{i}", "LAZY-SOFA", 1)
+
+    assert metrics.counters["product_cache_hits_total", ()] == 2
+    assert (
+        metrics.counters["product_cache_misses_total", (("reason", "absent"),)] == 1
+    )
+    assert ("product_cache_saved_seconds_total", ()) in metrics.counters
+
+
+def test_evicts_the_least_recently_used_product():
+    cache = ProductCache(maxsize=2)
+    products = [model.Product(sku, batches=[]) for sku in ("A", "B", "C")]
+    cache.checkin(products[:2])
+    cache.checkin([cache.checkout("A")])
+    cache.checkin(products[2:])
+
+    assert cache.checkout("B") is None
+    assert cache.checkout("A") is products[0]
+    assert cache.checkout("C") is products[2]
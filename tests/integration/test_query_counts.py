@@ -0,0 +1,166 @@
+import pytest
+from sqlalchemy import event
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+from .test_uow import insert_batch
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def add_product(session, sku, batch_count):
+    insert_batch(session, f"{sku}-0", sku, 100, None)
+    for i in range(1, batch_count):
+        session.execute(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:ref, :sku, 100, NULL)",
+            dict(ref=f"{sku}-{i}", sku=sku),
+        )
+    session.commit()
+
+
+def count_queries(engine, fn):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return len(statements)
+
+
+def queries_to_allocate(session_factory, engine, batch_count, loading):
+    sku = f"SOFA-{batch_count}"
+    add_product(session_factory(), sku, batch_count)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading=loading)
+    handlers.allocate(commands.Allocate("o1", sku, 10), uow)
+    return count_queries(
+        engine, lambda: handlers.allocate(commands.Allocate("o2", sku, 10), uow)
+    )
+
+
+def queries_to_change_batch_quantity(session_factory, engine, batch_count, loading):
+    sku = f"LAMP-{batch_count}"
+    add_product(session_factory(), sku, batch_count)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading=loading)
+    handlers.allocate(commands.Allocate("o1", sku, 10), uow)
+    return count_queries(
+        engine,
+        lambda: handlers.change_batch_quantity(
+            commands.ChangeBatchQuantity(f"{sku}-0", 50), uow
+        ),
+    )
+
+
+@pytest.mark.parametrize("loading", ["selectin", "joined"])
+def test_allocate_takes_the_same_queries_whatever_the_batch_count(
+    in_memory_sqlite_db, sqlite_session_factory, loading
+):
+    counts = [
+        queries_to_allocate(sqlite_session_factory, in_memory_sqlite_db, n, loading)
+        for n in (1, 5, 25)
+    ]
+    assert counts[0] == counts[1] == counts[2]
+    # load, check the chosen batch doesn't have the line, then write it, its
+    # allocation, the batch's allocated quantity, the version and the outbox
+    assert counts[0] == {"selectin": 2, "joined": 1}[loading] + 1 + 5
+
+
+@pytest.mark.parametrize("loading", ["selectin", "joined"])
+def test_change_batch_quantity_takes_the_same_queries_whatever_the_batch_count(
+    in_memory_sqlite_db, sqlite_session_factory, loading
+):
+    counts = [
+        queries_to_change_batch_quantity(
+            sqlite_session_factory, in_memory_sqlite_db, n, loading
+        )
+        for n in (1, 5, 25)
+    ]
+    assert counts[0] == counts[1] == counts[2]
+    # load, then update the batch quantity and the version
+    assert counts[0] == {"selectin": 2, "joined": 1}[loading] + 2
+
+
+def test_default_loading_leaves_order_lines_unloaded(sqlite_session_factory):
+    add_product(sqlite_session_factory(), "STOOL", 3)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    handlers.allocate(commands.Allocate("o1", "STOOL", 10), uow)
+    with uow:
+        batches = uow.products.get("STOOL").batches
+        assert not any("_allocations" in batch.__dict__ for batch in batches)
+
+
+def test_lazy_loading_no_longer_takes_a_query_per_batch(
+    in_memory_sqlite_db, sqlite_session_factory
+):
+    few, many = [
+        queries_to_allocate(sqlite_session_factory, in_memory_sqlite_db, n, "lazy")
+        for n in (1, 5)
+    ]
+    assert many == few
+
+
+def test_only_reads_order_lines_that_have_to_be_looked_at(
+    in_memory_sqlite_db, sqlite_session_factory
+):
+    add_product(sqlite_session_factory(), "CHAIR", 5)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    for i in range(5):
+        handlers.allocate(commands.Allocate(f"o{i}", "CHAIR", 10), uow)
+    statements = []
+    event.listen(
+        in_memory_sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("CHAIR-0", 60), uow)
+    assert not any("FROM order_lines" in s for s in statements)
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("CHAIR-0", 30), uow)
+    assert sum("FROM order_lines" in s for s in statements) == 1
+
+
+def test_allocates_without_reading_the_batch_lines(
+    in_memory_sqlite_db, sqlite_session_factory
+):
+    add_product(sqlite_session_factory(), "TABLE", 1)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    for i in range(5):
+        handlers.allocate(commands.Allocate(f"o{i}", "TABLE", 10), uow)
+    statements = []
+    event.listen(
+        in_memory_sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    handlers.allocate(commands.Allocate("o0", "TABLE", 10), uow)
+    handlers.allocate(commands.Allocate("o5", "TABLE", 10), uow)
+
+    assert not any("SELECT order_lines" in s for s in statements)
+    with uow:
+        [batch] = uow.products.get("TABLE").batches
+        assert batch.available_quantity == 40
+        assert len(batch._allocations) == 6
+
+
+def test_resolves_known_batch_references_without_searching_batches(
+    in_memory_sqlite_db, sqlite_session_factory
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "RUG", 100), uow)
+    statements = []
+    event.listen(
+        in_memory_sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("b1", 50), uow)
+
+    assert statements
+    assert not any("batches.reference =" in s for s in statements)
@@ -1,4 +1,5 @@
 import pytest
+from sqlalchemy import exc
 from allocation.adapters import repository
 from allocation.domain import model
 
@@ -17,3 +18,58 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_forgets_the_least_recently_used_batchref():
+    index = repository.BatchrefIndex(maxsize=2)
+    index["b1"], index["b2"] = "sku1", "sku1"
+    assert index.get("b1") == "sku1"
+    index["b3"] = "sku2"
+
+    assert len(index) == 2
+    assert index.get("b2") is None
+    assert index.get("b1") == "sku1"
+    assert index.get("b3") == "sku2"
+
+
+def test_batches_come_back_with_their_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    batch.allocate(model.OrderLine("o1", "sku1", 10))
+    batch.allocate(model.OrderLine("o2", "sku1", 15))
+    repository.SqlAlchemyRepository(session).add(
+        model.Product(sku="sku1", batches=[batch])
+    )
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    [loaded] = repo.get("sku1").batches
+    assert loaded.allocated_quantity == 25
+    loaded.deallocate_one()
+    assert loaded.available_quantity in (85, 90)
+
+
+def test_loaded_lines_share_their_sku_string(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    for orderid in ("o1", "o2"):
+        batch.allocate(model.OrderLine(orderid, "".join(["sku", "1"]), 10))
+    repository.SqlAlchemyRepository(session).add(
+        model.Product(sku="sku1", batches=[batch])
+    )
+    session.commit()
+
+    session = sqlite_session_factory()
+    [loaded] = repository.SqlAlchemyRepository(session).get("sku1").batches
+    line1, line2 = loaded._allocations
+    assert line1.sku is line2.sku is loaded.sku
+    assert not session.dirty
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product("sku1", [model.Batch("b1", "sku1", 100, eta=None)]))
+    repo.add(model.Product("sku2", [model.Batch("b1", "sku2", 100, eta=None)]))
+    with pytest.raises(exc.IntegrityError):
+        session.commit()
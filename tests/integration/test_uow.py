@@ -130,3 +130,28 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         uow.session.execute("select 1")
+
+
+def test_product_changed_since_read_is_a_concurrent_update(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "WOBBLY-STOOL", 100, None, product_version=1)
+    session.commit()
+
+    first = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    second = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with first, second:
+        first.products.get("WOBBLY-STOOL").allocate(
+            model.OrderLine("o1", "WOBBLY-STOOL", 10)
+        )
+        second.products.get("WOBBLY-STOOL").allocate(
+            model.OrderLine("o2", "WOBBLY-STOOL", 10)
+        )
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrentUpdate):
+            second.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='WOBBLY-STOOL'"
+    )
+    assert version == 2
+    assert get_allocated_batch_ref(session, "o1", "WOBBLY-STOOL") == "batch1"
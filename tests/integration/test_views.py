@@ -1,9 +1,11 @@
 # pylint: disable=redefined-outer-name
 from datetime import date
+from sqlalchemy import event
 from sqlalchemy.orm import clear_mappers
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters.views_cache import InMemoryViewsCache
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 
@@ -11,12 +13,17 @@ today = date.today()
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def views_cache():
+    return InMemoryViewsCache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, views_cache):
     bus = bootstrap.bootstrap(
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         notifications=mock.Mock(),
-        publish=lambda *args: None,
+        views_cache=views_cache,
     )
     yield bus
     clear_mappers()
@@ -47,3 +54,81 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_a_reallocation_cascade_updates_the_view_in_one_go(
+    sqlite_bus, in_memory_sqlite_db
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 100, today))
+    sqlite_bus.handle(
+        commands.AllocateMany("sku1", [(f"o{i}", 10) for i in range(10)])
+    )
+    statements = []
+    event.listen(
+        in_memory_sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 0))
+
+    view_writes = [s for s in statements if "allocations_view" in s]
+    assert len(view_writes) == 2  # one DELETE and one INSERT
+    assert views.allocations("o7", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_cached_allocations_are_dropped_when_they_change(sqlite_bus, views_cache):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 40))
+    before = views.cached_allocations("o1", sqlite_bus.uow, views_cache)
+    assert views_cache.get("o1") == before
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    assert views_cache.get("o1") is None
+    after = views.cached_allocations("o1", sqlite_bus.uow, views_cache)
+    assert after.rows == [{"sku": "sku1", "batchref": "b2"}]
+    assert after.etag != before.etag
+
+
+def test_does_not_cache_orders_with_no_allocations_yet(sqlite_bus, views_cache):
+    assert views.cached_allocations("o1", sqlite_bus.uow, views_cache).rows == []
+    assert views_cache.get("o1") is None
+
+
+def test_allocations_for_many_orders_in_one_query(sqlite_bus, in_memory_sqlite_db):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 1000, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku2", 1000, None))
+    orderids = [f"o{i:03}" for i in range(300)]
+    sqlite_bus.handle(commands.AllocateMany("sku1", [(o, 1) for o in orderids]))
+    sqlite_bus.handle(commands.AllocateMany("sku2", [(o, 1) for o in orderids[:2]]))
+    statements = []
+    event.listen(
+        in_memory_sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    rows = list(views.allocations_for(orderids + ["unknown"], sqlite_bus.uow))
+
+    assert len(statements) == 1
+    assert len(rows) == 302
+    assert rows[:3] == [
+        {"orderid": "o000", "sku": "sku1", "batchref": "b1"},
+        {"orderid": "o000", "sku": "sku2", "batchref": "b2"},
+        {"orderid": "o001", "sku": "sku1", "batchref": "b1"},
+    ]
+
+
+def test_allocations_for_chunks_long_lists_of_orders(sqlite_bus, monkeypatch):
+    monkeypatch.setattr(views, "QUERY_CHUNK_SIZE", 2)
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    orderids = ["o1", "o2", "o3", "o1"]
+    sqlite_bus.handle(commands.AllocateMany("sku1", [(o, 1) for o in orderids[:3]]))
+
+    rows = views.allocations_for(orderids, sqlite_bus.uow)
+    assert [row["orderid"] for row in rows] == ["o1", "o2", "o3"]
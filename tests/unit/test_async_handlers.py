@@ -0,0 +1,151 @@
+# pylint: disable=no-self-use
+from __future__ import annotations
+import asyncio
+import threading
+from datetime import date
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.adapters import repository
+from allocation.service_layer import handlers, unit_of_work
+from .test_handlers import FakeNotifications
+
+
+class FakeAsyncRepository(repository.AbstractAsyncRepository):
+    def __init__(self, products):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku):
+        await asyncio.sleep(0)
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref):
+        await asyncio.sleep(0)
+        return next(
+            (p for p in self._products for b in p.batches if b.reference == batchref),
+            None,
+        )
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+    def __init__(self):
+        self._products = FakeAsyncRepository([])
+        self.committed = False
+
+    @property
+    def products(self):
+        return self._products
+
+    async def _commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+def bootstrap_test_app(notifications=None):
+    return bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=notifications or FakeNotifications(),
+    )
+
+
+def handle(bus, *messages):
+    asyncio.run(bus.handle_many(messages))
+
+
+class TestAllocate:
+    def test_allocates(self):
+        bus = bootstrap_test_app()
+        handle(
+            bus,
+            commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None),
+            commands.Allocate("o1", "COMPLICATED-LAMP", 10),
+        )
+        [batch] = asyncio.run(bus.uow.products.get("COMPLICATED-LAMP")).batches
+        assert batch.available_quantity == 90
+        assert bus.uow.committed
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            handle(bus, commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+    def test_sends_email_from_the_executor_on_out_of_stock_error(self):
+        threads = []
+
+        class RecordingNotifications(FakeNotifications):
+            def send(self, destination, message):
+                threads.append(threading.current_thread())
+                super().send(destination, message)
+
+        fake_notifs = RecordingNotifications()
+        bus = bootstrap_test_app(fake_notifs)
+        handle(
+            bus,
+            commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None),
+            commands.Allocate("o1", "POPULAR-CURTAINS", 10),
+        )
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+        assert threads != [threading.main_thread()]
+
+
+class TestChangeBatchQuantity:
+    def test_reallocates_if_necessary(self):
+        bus = bootstrap_test_app()
+        handle(
+            bus,
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+            commands.ChangeBatchQuantity("batch1", 25),
+        )
+        product = asyncio.run(bus.uow.products.get(sku="INDIFFERENT-TABLE"))
+        [batch1, batch2] = product.batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 30
+
+    def test_reallocates_before_a_later_message_fails(self):
+        bus = bootstrap_test_app()
+        handle(
+            bus,
+            commands.CreateBatch("b1", "SHAGGY-TABLE", 10, None),
+            commands.CreateBatch("b2", "SHAGGY-TABLE", 10, date.today()),
+            commands.Allocate("o1", "SHAGGY-TABLE", 8),
+        )
+        with pytest.raises(handlers.InvalidSku):
+            handle(
+                bus,
+                commands.ChangeBatchQuantity("b1", 5),
+                commands.Allocate("o2", "NONEXISTENT", 1),
+            )
+        product = asyncio.run(bus.uow.products.get(sku="SHAGGY-TABLE"))
+        [b1, b2] = product.batches
+        assert b1.available_quantity == 5
+        assert b2.available_quantity == 2
+
+
+def test_handles_messages_concurrently():
+    bus = bootstrap_test_app()
+
+    async def allocate_everything():
+        await bus.handle(commands.CreateBatch("b1", "SHARED-DESK", 100, None))
+        await asyncio.gather(
+            *(
+                bus.handle(commands.Allocate(f"order{i}", "SHARED-DESK", 1))
+                for i in range(20)
+            )
+        )
+
+    asyncio.run(allocate_everything())
+    [batch] = asyncio.run(bus.uow.products.get("SHARED-DESK")).batches
+    assert batch.available_quantity == 80
@@ -1,5 +1,5 @@
 from datetime import date
-from allocation.domain.model import Batch, OrderLine
+from allocation.domain.model import Batch, LineStore, OrderLine, plan_deallocation
 
 
 def test_allocating_to_a_batch_reduces_the_available_quantity():
@@ -44,3 +44,64 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+class SetLineStore(LineStore):
+    def __init__(self):
+        self.lines = set()
+
+    def contains(self, batch, line):
+        return line in self.lines
+
+    def add(self, batch, line):
+        self.lines.add(line)
+
+
+def test_lines_kept_elsewhere_are_looked_up_and_added_there():
+    batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
+    batch.line_store = SetLineStore()
+    batch.allocate(line)
+    batch.allocate(line)
+
+    assert batch.line_store.lines == {line}
+    assert batch.available_quantity == 18
+    assert not batch._allocations
+
+
+def test_deallocating_returns_the_stock():
+    batch, line = make_batch_and_line("SLEEK-STOOL", 20, 2)
+    batch.allocate(line)
+
+    assert batch.deallocate_one() == line
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def lines_of(*qtys):
+    return [OrderLine(f"order{i}", "TINY-STOOL", qty) for i, qty in enumerate(qtys)]
+
+
+def test_deallocation_plan_covers_the_excess_with_the_fewest_lines():
+    plan = plan_deallocation(lines_of(2, 9, 3, 4, 2), 12)
+    assert sorted(line.qty for line in plan) == [3, 9]
+
+
+def test_deallocation_plan_frees_as_little_extra_as_it_can():
+    plan = plan_deallocation(lines_of(10, 8, 5, 1), 4)
+    assert [line.qty for line in plan] == [5]
+
+
+def test_deallocation_plan_is_empty_without_excess():
+    assert plan_deallocation(lines_of(10, 8), 0) == []
+
+
+def test_deallocating_excess_brings_a_batch_back_within_its_quantity():
+    batch = Batch("batch-001", "TINY-STOOL", 20, eta=None)
+    for line in lines_of(2, 6, 4, 8):
+        batch.allocate(line)
+    batch._purchased_quantity = 11
+
+    freed = batch.deallocate_excess()
+
+    assert sorted(line.qty for line in freed) == [2, 8]
+    assert batch.available_quantity == 1
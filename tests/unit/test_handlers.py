@@ -1,12 +1,14 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from typing import Dict, List
 import pytest
 from allocation import bootstrap
-from allocation.domain import commands
-from allocation.service_layer import handlers
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus
 from allocation.adapters import notifications, repository
 from allocation.service_layer import unit_of_work
 
@@ -54,7 +56,6 @@ def bootstrap_test_app():
         start_orm=False,
         uow=FakeUnitOfWork(),
         notifications=FakeNotifications(),
-        publish=lambda *args: None,
     )
 
 
@@ -101,7 +102,6 @@ class TestAllocate:
             start_orm=False,
             uow=FakeUnitOfWork(),
             notifications=fake_notifs,
-            publish=lambda *args: None,
         )
         bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
         bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
@@ -110,6 +110,79 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_allocates_every_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "WOBBLY-SHELF", 100, None))
+        bus.handle(commands.AllocateMany("WOBBLY-SHELF", [("o1", 10), ("o2", 20)]))
+        [batch] = bus.uow.products.get("WOBBLY-SHELF").batches
+        assert batch.available_quantity == 70
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(commands.AllocateMany("NONEXISTENTSKU", [("o1", 10)]))
+
+    def test_sends_one_email_per_line_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+        )
+        bus.handle(commands.CreateBatch("b1", "SQUEAKY-DOOR", 9, None))
+        bus.handle(
+            commands.AllocateMany("SQUEAKY-DOOR", [("o1", 5), ("o2", 5), ("o3", 5)])
+        )
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for SQUEAKY-DOOR",
+            "Out of stock for SQUEAKY-DOOR",
+        ]
+
+
+class TestHandleMany:
+    def test_handles_each_message_and_its_events_in_turn(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+        )
+        bus.handle_many(
+            [
+                commands.CreateBatch("b1", "FLUFFY-RUG", 10, None),
+                commands.Allocate("o1", "FLUFFY-RUG", 8),
+                commands.Allocate("o2", "FLUFFY-RUG", 8),
+                commands.ChangeBatchQuantity("b1", 16),
+                commands.Allocate("o3", "FLUFFY-RUG", 8),
+            ]
+        )
+        [batch] = bus.uow.products.get("FLUFFY-RUG").batches
+        assert batch.available_quantity == 0
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for FLUFFY-RUG"]
+
+    def test_finishes_a_cascade_before_a_later_message_fails(self):
+        bus = bootstrap_test_app()
+        bus.handle_many(
+            [
+                commands.CreateBatch("b1", "SHAGGY-RUG", 10, None),
+                commands.CreateBatch("b2", "SHAGGY-RUG", 10, date.today()),
+                commands.Allocate("o1", "SHAGGY-RUG", 8),
+            ]
+        )
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle_many(
+                [
+                    commands.ChangeBatchQuantity("b1", 5),
+                    commands.Allocate("o2", "NONEXISTENT", 1),
+                ]
+            )
+        [b1, b2] = bus.uow.products.get("SHAGGY-RUG").batches
+        assert b1.available_quantity == 5
+        assert b2.available_quantity == 2
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -140,3 +213,189 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestLanes:
+    def test_background_handlers_run_after_the_foreground_cascade(self):
+        bus = bootstrap_test_app()
+        calls = []
+        bus.event_handlers[events.Allocated] = [
+            messagebus.background(lambda e: calls.append(("background", e.orderid))),
+            lambda e: calls.append(("foreground", e.orderid)),
+        ]
+        bus.handle(commands.CreateBatch("b1", "LOUD-LAMP", 100, None))
+        bus.handle(commands.AllocateMany("LOUD-LAMP", [("o1", 10), ("o2", 10)]))
+
+        assert calls == [
+            ("foreground", "o1"),
+            ("foreground", "o2"),
+            ("background", "o1"),
+            ("background", "o2"),
+        ]
+
+    def test_hands_background_handlers_to_an_executor(self):
+        worker = ThreadPoolExecutor(max_workers=1)
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            background=worker,
+            background_uow=FakeUnitOfWork(),
+        )
+        release, threads = threading.Event(), []
+
+        @messagebus.background
+        def slow_side_effect(event):
+            release.wait(timeout=5)
+            threads.append(threading.current_thread())
+
+        bus.event_handlers[events.Allocated] = [slow_side_effect]
+        bus.handle(commands.CreateBatch("b1", "LOUD-LAMP", 100, None))
+        bus.handle(commands.Allocate("o1", "LOUD-LAMP", 10))
+        assert threads == []  # the caller didn't wait for it
+
+        release.set()
+        worker.shutdown(wait=True)
+        assert threads and threads[0] is not threading.current_thread()
+
+    def test_batched_handlers_get_the_whole_cascade_in_one_call(self):
+        bus = bootstrap_test_app()
+        calls = []
+        view = messagebus.batched(lambda es: calls.append([type(e) for e in es]))
+        bus.event_handlers[events.Allocated] = [view]
+        bus.event_handlers[events.Deallocated][0] = view  # before reallocate
+        bus.handle(commands.CreateBatch("b1", "LOUD-LAMP", 100, None))
+        bus.handle(commands.CreateBatch("b2", "LOUD-LAMP", 100, None))
+        bus.handle(commands.AllocateMany("LOUD-LAMP", [("o1", 40), ("o2", 40)]))
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+        Allocated, Deallocated = events.Allocated, events.Deallocated
+        assert calls == [
+            [Allocated, Allocated],
+            [Deallocated, Deallocated, Allocated, Allocated],
+        ]
+
+    def test_background_handlers_still_run_when_a_later_message_fails(self):
+        bus = bootstrap_test_app()
+        calls = []
+        bus.event_handlers[events.Allocated] = [
+            messagebus.background(lambda e: calls.append(e.orderid)),
+        ]
+        bus.handle(commands.CreateBatch("b1", "LOUD-LAMP", 100, None))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle_many(
+                [
+                    commands.Allocate("o1", "LOUD-LAMP", 10),
+                    commands.Allocate("o2", "NONEXISTENT", 10),
+                ]
+            )
+        assert calls == ["o1"]
+
+    def test_background_handlers_follow_the_foreground_ones(self):
+        bus = bootstrap_test_app()
+        seen = []
+        record = messagebus.background(lambda e: seen.append(type(e).__name__))
+        bus.event_handlers[events.Allocated] = [record]
+        bus.event_handlers[events.Deallocated].append(record)
+        bus.handle_many(
+            [
+                commands.CreateBatch("b1", "QUIET-LAMP", 10, None),
+                commands.CreateBatch("b2", "QUIET-LAMP", 10, date.today()),
+                commands.Allocate("o1", "QUIET-LAMP", 8),
+            ]
+        )
+        seen.clear()
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle_many(
+                [
+                    commands.ChangeBatchQuantity("b1", 5),
+                    commands.Allocate("o2", "NONEXISTENT", 1),
+                ]
+            )
+        # the line was deallocated and reallocated, and both reach the view
+        assert seen == ["Deallocated", "Allocated"]
+
+    def test_notifications_go_to_the_background_lane(self):
+        assert (
+            messagebus.lane_of(handlers.send_out_of_stock_notification)
+            == messagebus.BACKGROUND
+        )
+        assert messagebus.lane_of(handlers.reallocate) == messagebus.FOREGROUND
+
+
+class TestAllocationsViewChanges:
+    def test_last_deallocation_wins_over_earlier_allocations(self):
+        deletes, inserts = handlers.allocations_view_changes(
+            [
+                events.Allocated("o1", "LAMP", 10, "b1"),
+                events.Deallocated("o1", "LAMP", 10),
+                events.Allocated("o1", "LAMP", 10, "b2"),
+                events.Allocated("o2", "LAMP", 10, "b1"),
+            ]
+        )
+        assert deletes == [{"orderid": "o1", "sku": "LAMP"}]
+        assert inserts == [
+            {"orderid": "o1", "sku": "LAMP", "batchref": "b2"},
+            {"orderid": "o2", "sku": "LAMP", "batchref": "b1"},
+        ]
+
+    def test_only_deletes_lines_that_were_deallocated(self):
+        deletes, inserts = handlers.allocations_view_changes(
+            [events.Allocated("o1", "LAMP", 10, "b1")]
+        )
+        assert deletes == []
+        assert len(inserts) == 1
+
+
+class TestBootstrap:
+    def test_default_adapters_do_not_connect_until_used(self):
+        # no database, SMTP or Redis server is running for the unit tests
+        bus = bootstrap.bootstrap(start_orm=False)
+        assert isinstance(bus.uow, unit_of_work.SqlAlchemyUnitOfWork)
+
+
+class TestRetries:
+    def flaky_allocate(self, failures):
+        calls = []
+
+        def handler(cmd):
+            calls.append(cmd)
+            if len(calls) <= failures:
+                raise unit_of_work.ConcurrentUpdate("version changed")
+
+        return handler, calls
+
+    def test_retries_commands_that_hit_a_concurrent_update(self):
+        bus = bootstrap_test_app()
+        bus.retries, bus.backoff = 3, 0
+        bus.command_handlers[commands.Allocate], calls = self.flaky_allocate(2)
+
+        bus.handle(commands.Allocate("o1", "WOBBLY-STOOL", 10))
+        assert len(calls) == 3
+
+    def test_gives_up_after_the_retry_limit(self):
+        bus = bootstrap_test_app()
+        bus.retries, bus.backoff = 3, 0
+        bus.command_handlers[commands.Allocate], calls = self.flaky_allocate(4)
+
+        with pytest.raises(unit_of_work.ConcurrentUpdate):
+            bus.handle(commands.Allocate("o1", "WOBBLY-STOOL", 10))
+        assert len(calls) == 4
+
+
+class TestImportBatches:
+    def test_creates_products_and_batches(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b0", "GREEN-CHAIR", 5, None))
+        bus.handle(
+            commands.ImportBatches(
+                [
+                    ("b1", "GREEN-CHAIR", 10, None),
+                    ("b2", "RED-CHAIR", 20, date.today()),
+                ]
+            )
+        )
+        green = bus.uow.products.get("GREEN-CHAIR")
+        assert [b.reference for b in green.batches] == ["b0", "b1"]
+        assert bus.uow.products.get("RED-CHAIR").batches[0].eta == date.today()
+        assert bus.uow.committed
@@ -0,0 +1,35 @@
+from dataclasses import asdict
+from datetime import date
+import pytest
+from allocation.domain import commands, events
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        commands.Allocate("o1", "TINY-BOWL", 10),
+        commands.AllocateMany("TINY-BOWL", [("o1", 10)]),
+        commands.CreateBatch("b1", "TINY-BOWL", 100),
+        commands.ChangeBatchQuantity("b1", 50),
+        events.Allocated("o1", "TINY-BOWL", 10, "b1"),
+        events.Deallocated("o1", "TINY-BOWL", 10),
+        events.OutOfStock("TINY-BOWL"),
+    ],
+)
+def test_messages_are_slotted(message):
+    assert not hasattr(message, "__dict__")
+    with pytest.raises(AttributeError):
+        message.unexpected = "attribute"
+
+
+def test_slotted_messages_keep_their_dataclass_behaviour():
+    cmd = commands.CreateBatch("b1", "TINY-BOWL", 100)
+    assert cmd.eta is None
+    assert cmd == commands.CreateBatch("b1", "TINY-BOWL", 100, eta=None)
+    assert asdict(commands.CreateBatch("b1", "TINY-BOWL", 100, date(2011, 1, 1))) == {
+        "ref": "b1",
+        "sku": "TINY-BOWL",
+        "qty": 100,
+        "eta": date(2011, 1, 1),
+    }
+    assert isinstance(events.OutOfStock("TINY-BOWL"), events.Event)
@@ -0,0 +1,88 @@
+# pylint: disable=no-self-use
+import pytest
+from allocation import bootstrap
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+def bootstrap_test_app(metrics):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        metrics=metrics,
+    )
+
+
+class TestMessageBusMetrics:
+    def test_times_each_handler_by_name(self):
+        metrics = InMemoryMetrics()
+        bus = bootstrap_test_app(metrics)
+        bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+        bus.handle(commands.Allocate("o1", "GARISH-RUG", 10))
+
+        labels = (("handler", "allocate"), ("message", "Allocate"))
+        assert metrics.counters["messagebus_messages_total", labels] == 1
+        assert metrics.histograms["messagebus_handler_seconds", labels].count == 1
+        assert metrics.histograms["uow_commit_seconds", ()].count == 2
+
+    def test_counts_exceptions_by_handler_and_message(self):
+        metrics = InMemoryMetrics()
+        bus = bootstrap_test_app(metrics)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NONEXISTENT", 10))
+
+        labels = (("handler", "allocate"), ("message", "Allocate"))
+        assert metrics.counters["messagebus_exceptions_total", labels] == 1
+
+    def test_records_cascade_length_and_queue_depth(self):
+        metrics = InMemoryMetrics()
+        bus = bootstrap_test_app(metrics)
+        bus.handle_many(
+            [
+                commands.CreateBatch("b1", "GARISH-RUG", 100, None),
+                commands.AllocateMany("GARISH-RUG", [("o1", 10), ("o2", 10)]),
+            ]
+        )
+
+        cascade = metrics.histograms["messagebus_cascade_length", ()]
+        assert cascade.count == 2  # one per command
+        assert cascade.sum == 1 + 3  # AllocateMany raises two Allocated events
+        depth = metrics.histograms["messagebus_queue_depth", ()]
+        assert depth.count == 4
+        assert depth.sum == 1 + 1 + 2 + 1  # each command's cascade in turn
+
+    def test_reports_how_far_the_read_model_lags_behind(self):
+        metrics = InMemoryMetrics()
+        bus = bootstrap_test_app(metrics)
+        bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+        bus.handle(commands.AllocateMany("GARISH-RUG", [("o1", 10), ("o2", 10)]))
+
+        labels = (("handler", "update_allocations_view"),)
+        lag = metrics.histograms["messagebus_deferred_lag_seconds", labels]
+        assert lag.count == 1  # once for both events
+
+    def test_renders_prometheus_text(self):
+        metrics = InMemoryMetrics()
+        metrics.increment("messagebus_messages_total", {"message": "Allocate"})
+        metrics.observe("messagebus_handler_seconds", 0.003, {"handler": "allocate"})
+
+        lines = metrics.render().splitlines()
+        assert "# TYPE messagebus_messages_total counter" in lines
+        assert 'messagebus_messages_total{message="Allocate"} 1' in lines
+        assert "# TYPE messagebus_handler_seconds histogram" in lines
+        assert (
+            'messagebus_handler_seconds_bucket{handler="allocate",le="0.0025"} 0'
+            in lines
+        )
+        assert (
+            'messagebus_handler_seconds_bucket{handler="allocate",le="0.005"} 1'
+            in lines
+        )
+        assert (
+            'messagebus_handler_seconds_bucket{handler="allocate",le="+Inf"} 1'
+            in lines
+        )
+        assert 'messagebus_handler_seconds_count{handler="allocate"} 1' in lines
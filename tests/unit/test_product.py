@@ -72,3 +72,125 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_batch_changes_also_increment_version_number():
+    product = Product(sku="SCANDI-PEN", batches=[], version_number=7)
+    product.add_batch(Batch("b1", "SCANDI-PEN", 100, eta=None))
+    assert product.version_number == 8
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 9
+
+
+def test_prefers_batches_added_later_if_they_arrive_sooner():
+    shipment_batch = Batch("shipment-batch", "CHEAP-SOFA", 100, eta=later)
+    product = Product(sku="CHEAP-SOFA", batches=[shipment_batch])
+    product.allocate(OrderLine("order1", "CHEAP-SOFA", 10))
+
+    in_stock_batch = Batch("in-stock-batch", "CHEAP-SOFA", 100, eta=None)
+    product.add_batch(in_stock_batch)
+    product.allocate(OrderLine("order2", "CHEAP-SOFA", 10))
+
+    assert in_stock_batch.available_quantity == 90
+    assert shipment_batch.available_quantity == 90
+
+
+def test_skips_batches_without_enough_stock_left():
+    earliest = Batch("speedy-batch", "SHINY-VASE", 10, eta=today)
+    latest = Batch("slow-batch", "SHINY-VASE", 100, eta=later)
+    product = Product(sku="SHINY-VASE", batches=[latest, earliest])
+
+    assert (
+        product.allocate(OrderLine("order1", "SHINY-VASE", 8)) == earliest.reference
+    )
+    assert product.allocate(OrderLine("order2", "SHINY-VASE", 8)) == latest.reference
+    assert (
+        product.allocate(OrderLine("order3", "SHINY-VASE", 2)) == earliest.reference
+    )
+
+
+def test_uses_stock_freed_up_by_a_batch_quantity_change():
+    earliest = Batch("speedy-batch", "TALL-LAMP", 10, eta=today)
+    latest = Batch("slow-batch", "TALL-LAMP", 100, eta=later)
+    product = Product(sku="TALL-LAMP", batches=[earliest, latest])
+    product.allocate(OrderLine("order1", "TALL-LAMP", 10))
+
+    product.change_batch_quantity("speedy-batch", 30)
+
+    assert (
+        product.allocate(OrderLine("order2", "TALL-LAMP", 20)) == earliest.reference
+    )
+
+
+def test_moves_on_from_a_batch_that_changed_behind_the_index():
+    earliest = Batch("speedy-batch", "SOFT-RUG", 10, eta=today)
+    latest = Batch("slow-batch", "SOFT-RUG", 100, eta=later)
+    product = Product(sku="SOFT-RUG", batches=[earliest, latest])
+    product.allocate(OrderLine("order1", "SOFT-RUG", 1))
+    earliest.allocate(OrderLine("order2", "SOFT-RUG", 9))
+
+    assert product.allocate(OrderLine("order3", "SOFT-RUG", 5)) == latest.reference
+    assert product.allocate(OrderLine("order4", "SOFT-RUG", 95)) == latest.reference
+
+
+def test_skips_batches_of_other_skus():
+    other = Batch("other-batch", "ODD-RUG", 100, eta=None)
+    batch = Batch("rug-batch", "SOFT-RUG", 100, eta=today)
+    product = Product(sku="SOFT-RUG", batches=[other, batch])
+
+    assert product.allocate(OrderLine("order1", "SOFT-RUG", 10)) == batch.reference
+    assert other.available_quantity == 100
+    assert product.allocate(OrderLine("order2", "SOFT-RUG", 90)) == batch.reference
+
+
+def test_allocate_many_fills_batches_in_preference_order():
+    in_stock_batch = Batch("in-stock-batch", "BLUE-CUSHION", 20, eta=None)
+    shipment_batch = Batch("shipment-batch", "BLUE-CUSHION", 20, eta=tomorrow)
+    product = Product(sku="BLUE-CUSHION", batches=[shipment_batch, in_stock_batch])
+    lines = [OrderLine(f"order{i}", "BLUE-CUSHION", 8) for i in range(6)]
+
+    allocations = product.allocate_many(lines)
+
+    assert allocations == [
+        "in-stock-batch",
+        "in-stock-batch",
+        "shipment-batch",
+        "shipment-batch",
+        None,
+        None,
+    ]
+    assert in_stock_batch.available_quantity == 4
+    assert shipment_batch.available_quantity == 4
+
+
+def test_allocate_many_outputs_an_event_per_line():
+    batch = Batch("batchref", "GREEN-CUSHION", 10, eta=None)
+    product = Product(sku="GREEN-CUSHION", batches=[batch])
+
+    product.allocate_many(
+        [
+            OrderLine("order1", "GREEN-CUSHION", 6),
+            OrderLine("order2", "GREEN-CUSHION", 6),
+        ]
+    )
+
+    assert product.events == [
+        events.Allocated(
+            orderid="order1", sku="GREEN-CUSHION", qty=6, batchref="batchref"
+        ),
+        events.OutOfStock(sku="GREEN-CUSHION"),
+    ]
+
+
+def test_deallocates_as_few_lines_as_possible_when_a_batch_shrinks():
+    batch = Batch("batch1", "LONG-BENCH", 100, eta=None)
+    product = Product(sku="LONG-BENCH", batches=[batch])
+    product.allocate(OrderLine("big-order", "LONG-BENCH", 30))
+    for i in range(10):
+        product.allocate(OrderLine(f"small-order{i}", "LONG-BENCH", 5))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 60)
+
+    assert product.events == [events.Deallocated("big-order", "LONG-BENCH", 30)]
+    assert batch.available_quantity == 10
@@ -0,0 +1,82 @@
+# pylint: disable=no-self-use
+import threading
+from typing import List
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands, model
+from allocation.service_layer import handlers
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+def bootstrap_test_app(notifications_factory=FakeNotifications, shards=4):
+    return bootstrap.bootstrap_sharded(
+        shards=shards,
+        start_orm=False,
+        uow_factory=FakeUnitOfWork,
+        notifications_factory=notifications_factory,
+    )
+
+
+def shard_of(bus, sku):
+    return bus.shard_for(commands.Allocate("", sku, 0))
+
+
+def test_keeps_the_order_of_messages_for_a_sku():
+    bus = bootstrap_test_app()
+    bus.handle_many(
+        [commands.CreateBatch("b1", "STURDY-CRATE", 100, None)]
+        + [commands.Allocate(f"o{i}", "STURDY-CRATE", 10) for i in range(12)]
+        + [commands.ChangeBatchQuantity("b1", 110)]
+    )
+    products = bus.buses[shard_of(bus, "STURDY-CRATE")].uow.products
+    [batch] = products.get("STURDY-CRATE").batches
+    assert batch.available_quantity == 10
+    bus.close()
+
+
+def test_runs_skus_on_different_shards_in_parallel():
+    both_sending = threading.Barrier(2, timeout=5)
+    sent = []  # type: List[str]
+
+    class WaitingNotifications(FakeNotifications):
+        def send(self, destination, message):
+            both_sending.wait()
+            sent.append(message)
+
+    bus = bootstrap_test_app(notifications_factory=WaitingNotifications)
+    sku1 = "sku-0"
+    sku2 = next(
+        f"sku-{i}"
+        for i in range(1, 100)
+        if shard_of(bus, f"sku-{i}") != shard_of(bus, sku1)
+    )
+    bus.handle_many(
+        [
+            commands.CreateBatch("b1", sku1, 0, None),
+            commands.CreateBatch("b2", sku2, 0, None),
+            commands.Allocate("o1", sku1, 10),
+            commands.Allocate("o2", sku2, 10),
+        ]
+    )
+    assert sorted(sent) == sorted(
+        [f"Out of stock for {sku1}", f"Out of stock for {sku2}"]
+    )
+    bus.close()
+
+
+def test_looks_up_the_sku_for_a_batch_it_has_not_seen():
+    bus = bootstrap_test_app()
+    bus.uow.products.add(
+        model.Product("SHY-LAMP", [model.Batch("shy-batch", "SHY-LAMP", 10, None)])
+    )
+    assert bus.shard_for(commands.ChangeBatchQuantity("shy-batch", 5)) == shard_of(
+        bus, "SHY-LAMP"
+    )
+    bus.close()
+
+
+def test_errors_reach_the_caller():
+    bus = bootstrap_test_app()
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+        bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+    bus.close()
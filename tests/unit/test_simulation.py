@@ -0,0 +1,75 @@
+import random
+from datetime import date, timedelta
+import numpy as np
+import pytest
+from allocation.domain import simulation
+from allocation.domain.model import Product, OrderLine, Batch
+
+
+today = date.today()
+
+
+def make_product(seed, allocate_first=()):
+    rng = random.Random(seed)
+    batches = [
+        Batch(
+            f"batch{i}",
+            # now and then a batch of another sku, which lines never go to
+            "FANCY-TEAPOT" if rng.random() < 0.8 else "PLAIN-TEAPOT",
+            rng.randint(0, 60),
+            eta=None if rng.random() < 0.3 else today + timedelta(rng.randint(0, 5)),
+        )
+        for i in range(rng.randint(0, 12))
+    ]
+    product = Product(sku="FANCY-TEAPOT", batches=batches)
+    for i, qty in enumerate(allocate_first):
+        product.allocate(OrderLine(f"existing{i}", "FANCY-TEAPOT", qty))
+    return product
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_matches_product_allocate(seed):
+    rng = random.Random(seed)
+    existing = [rng.randint(1, 15) for _ in range(rng.randint(0, 5))]
+    qtys = [rng.randint(0, 25) for _ in range(rng.randint(0, 80))]
+
+    result = simulation.simulate(make_product(seed, existing), qtys)
+
+    product = make_product(seed, existing)
+    expected = [
+        product.allocate(OrderLine(f"order{i}", "FANCY-TEAPOT", qty))
+        for i, qty in enumerate(qtys)
+    ]
+    assert [
+        result.batchrefs[position] if position >= 0 else None
+        for position in result.assignments
+    ] == expected
+    by_ref = {b.reference: b for b in product.batches}
+    assert list(result.allocated) == [
+        by_ref[ref].allocated_quantity for ref in result.batchrefs
+    ]
+    assert list(result.out_of_stock) == [
+        i for i, batchref in enumerate(expected) if batchref is None
+    ]
+
+
+def test_skips_batches_of_other_skus():
+    other = Batch("other", "PLAIN-CUP", 100, eta=None)
+    batch = Batch("batch", "FANCY-CUP", 100, eta=None)
+    product = Product(sku="FANCY-CUP", batches=[other, batch])
+
+    result = simulation.simulate(product, [10])
+
+    assert result.batchrefs[result.assignments[0]] == "batch"
+    assert product.allocate(OrderLine("order", "FANCY-CUP", 10)) == "batch"
+
+
+def test_leaves_the_product_alone():
+    batch = Batch("batch1", "PLAIN-MUG", 10, eta=None)
+    product = Product(sku="PLAIN-MUG", batches=[batch])
+
+    result = simulation.simulate(product, np.full(5, 3))
+
+    assert list(result.available) == [1]
+    assert batch.available_quantity == 10
+    assert product.events == []
@@ -0,0 +1,62 @@
+# pylint: disable=no-self-use
+from unittest import mock
+from allocation.adapters.views_cache import (
+    Entry,
+    InMemoryViewsCache,
+    TieredViewsCache,
+)
+
+ROWS = [{"sku": "LAMP", "batchref": "b1"}]
+
+
+class TestEntry:
+    def test_etag_follows_the_content(self):
+        assert Entry.of(ROWS).etag == Entry.of([dict(r) for r in ROWS]).etag
+        assert Entry.of(ROWS).etag != Entry.of([]).etag
+
+
+class TestInMemoryViewsCache:
+    def test_entries_expire_after_the_ttl(self):
+        cache = InMemoryViewsCache(ttl=10)
+        with mock.patch("time.monotonic", return_value=100.0):
+            cache.set("o1", Entry.of(ROWS))
+        with mock.patch("time.monotonic", return_value=109.0):
+            assert cache.get("o1").rows == ROWS
+        with mock.patch("time.monotonic", return_value=110.0):
+            assert cache.get("o1") is None
+
+    def test_evicts_the_least_recently_used(self):
+        cache = InMemoryViewsCache(maxsize=2)
+        cache.set("o1", Entry.of(ROWS))
+        cache.set("o2", Entry.of(ROWS))
+        cache.get("o1")
+        cache.set("o3", Entry.of(ROWS))
+
+        assert cache.get("o2") is None
+        assert cache.get("o1") is not None
+        assert len(cache) == 2
+
+    def test_invalidates_many_orders_at_once(self):
+        cache = InMemoryViewsCache()
+        for orderid in ("o1", "o2", "o3"):
+            cache.set(orderid, Entry.of(ROWS))
+        cache.invalidate("o1", "o2")
+        assert len(cache) == 1
+
+
+class TestTieredViewsCache:
+    def test_fills_the_local_tier_from_the_shared_one(self):
+        shared = InMemoryViewsCache()
+        cache = TieredViewsCache(InMemoryViewsCache(), shared)
+        shared.set("o1", Entry.of(ROWS))
+
+        assert cache.get("o1").rows == ROWS
+        shared.invalidate("o1")
+        assert cache.get("o1").rows == ROWS  # until its own TTL runs out
+
+    def test_invalidates_both_tiers(self):
+        local, shared = InMemoryViewsCache(), InMemoryViewsCache()
+        cache = TieredViewsCache(local, shared)
+        cache.set("o1", Entry.of(ROWS))
+        cache.invalidate("o1")
+        assert local.get("o1") is None and shared.get("o1") is None